@@ -1,8 +1,21 @@
 import logging
+import argparse
+import signal
+import multiprocessing
 import sqlite3
 import asyncio
+import time
+import os
+import cProfile
+import pstats
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
 from typing import List, Dict, Tuple
 from telegram import (
+    Bot,
     Update, 
     InlineKeyboardButton, 
     InlineKeyboardMarkup, 
@@ -13,14 +26,32 @@ from telegram.ext import (
     CommandHandler, 
     CallbackQueryHandler, 
     MessageHandler, 
+    ChatMemberHandler,
+    TypeHandler,
     ContextTypes, 
+    BaseUpdateProcessor,
+    BaseRateLimiter,
+    BasePersistence,
+    PersistenceInput,
     filters
 )
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter, NetworkError, Forbidden
+from telegram.request import HTTPXRequest
+from telegram.constants import ParseMode
 import aiohttp
+from aiohttp import web
 import io
+import functools
+import bisect
+import heapq
+import array
+import itertools
+import json
+import hashlib
+import html
 from PIL import Image, ImageDraw, ImageFont
 import random
+import secrets
 import string
 
 # Configure logging
@@ -35,216 +66,2609 @@ BOT_TOKEN = "8338878571:AAEyXWfoFLcvJOp3dH3i73U1MHEXl1n9-Bc"
 DOMAIN = "https://yourdomain.com"
 ADMIN_IDS = [6664251010]  # Replace with your admin user IDs
 VERIFICATION_CODE = "AB12CD"  # Fixed verification code for all users
+MEMBERSHIP_CHECK_CONCURRENCY = 8  # Parallel getChatMember calls per verification
+MEMBERSHIP_CHECK_RETRIES = 3  # Retries on network errors before giving up on a channel (RetryAfter: OUTBOUND_RETRIES)
+MEMBERSHIP_STOP_ON_FIRST_MISSING = False  # Stop checking once one channel is confirmed not joined
+MEMBERSHIP_INDEX_MAX_AGE = 6 * 3600  # Seconds an indexed membership is trusted before getChatMember is asked again
+BROADCAST_RATE = 25  # Messages per second, just under Telegram's ~30/s global limit
+BROADCAST_CONCURRENCY = 10  # Sends in flight at once
+BROADCAST_CHUNK_SIZE = 500  # Recipients loaded from the database per batch
+BROADCAST_MAX_RETRIES = 3  # Retries per recipient on network errors (RetryAfter: OUTBOUND_RETRIES)
+BROADCAST_PROGRESS_INTERVAL = 5  # Seconds between progress flushes and admin updates
+FUNNEL_CACHE_SIZE = 100000  # Users whose funnel state is kept in memory
+KNOWN_USERS_CACHE_SIZE = 200000  # Registered user ids remembered to skip repeat /start writes
+USER_FLUSH_INTERVAL = 1.0  # Seconds between flushes of buffered registrations
+USER_FLUSH_BATCH = 500  # Buffered registrations that trigger an immediate flush
+IMAGE_FONT_PATH = "arial.ttf"  # You might need to adjust font path based on your system
+IMAGE_FONT_SIZE = 30
+PHOTO_MAX_SIDE = 1280  # Telegram shows photos at most this many pixels on the long side
+PHOTO_FORMAT = 'JPEG'  # Upload encoding for rendered photos: 'JPEG' or 'WEBP'
+PHOTO_BYTE_BUDGET = 200 * 1024  # Largest encoded render we aim to upload
+PHOTO_QUALITIES = (85, 75, 65, 50)  # Tried in order until the encoded render fits the budget
+PHOTO_BACKGROUND = (255, 255, 255)  # Colour under transparent parts of a source image
+IMAGE_CACHE_REVALIDATE_SECONDS = 600  # How often a cached render is checked against its source image
+HTTP_POOL_SIZE = 20  # Connections kept by the shared aiohttp session
+HTTP_KEEPALIVE_TIMEOUT = 60
+HTTP_TIMEOUT = 15
+RENDER_WORKERS = 2  # Threads doing PIL work; PIL releases the GIL while decoding/encoding
+RENDER_QUEUE_SIZE = 32  # Renders queued or running before new ones are refused
+UPDATE_WORKERS = 32  # Updates processed concurrently; each user's updates still run in order
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_URL = ""  # Public base URL, e.g. https://yourdomain.com; empty skips setWebhook (local testing)
+WEBHOOK_SECRET = ""  # Checked against X-Telegram-Bot-Api-Secret-Token; empty picks a random one per start
+METRICS_ENABLED = True  # Handler/DB/Bot API timing; off means no instrumentation at all
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100  # Prometheus-style text at /metrics
+BOT_API_POOL_SIZE = 256  # Connections for Bot API calls (the builder's default)
+ADMIN_DIGEST_INTERVAL = 30  # Seconds between payment request digests sent to admins
+ADMIN_DIGEST_MAX_ITEMS = 25  # Payment requests per digest message
+MESSAGE_MAX_LENGTH = 4096  # Characters Telegram accepts in one message
+UPI_ID_MAX_LENGTH = 64  # Longer "UPI IDs" are refused; real ones are well under this
+ADMIN_NOTIFY_RETRIES = 5  # Retries per digest on network errors (RetryAfter: OUTBOUND_RETRIES)
+PAYMENTS_PAGE_SIZE = 10  # Pending payments per admin review page
+FUNNEL_CHART_DAYS = 14  # Days shown on the admin trend chart
+FLOOD_LIMITS = {  # Per-user (requests per second, burst) for each guarded handler
+    'start': (0.2, 3),
+    'verify_join': (0.5, 3),
+    'code': (0.5, 5),
+    'upi': (0.2, 3),
+}
+FLOOD_TRACKED_USERS = 50000  # Per-user buckets kept; the least recently seen are dropped first
+FLOOD_BUSY_PENDING = 256  # Unfinished updates at which handlers stop rendering images
+FLOOD_SHED_PENDING = 2048  # Unfinished updates at which guarded handlers are refused outright
+OUTBOUND_RATE = 30  # Messages per second across all chats
+OUTBOUND_PER_CHAT_RATE = 1  # Messages per second to one private chat
+OUTBOUND_GROUP_RATE = 20 / 60  # Messages per second to one group or channel
+OUTBOUND_CHAT_BURST = 3  # Messages a chat may receive back to back before its rate applies
+OUTBOUND_CHAT_BUCKETS = 10000  # Per-chat buckets kept; the least recently used are dropped first
+OUTBOUND_RETRIES = 2  # RetryAfter retries made by the scheduler before the caller sees the error
+OUTBOUND_BULK_RESERVE = 5  # Global tokens bulk sends leave untouched for everyone else's replies
+PERSISTENCE_INTERVAL = 30  # Seconds between saves of user_data and the warm-start snapshot
+SUPERVISOR_WORKERS = 4  # Worker processes started in supervisor mode
+WORKER_BASE_PORT = 8600  # Worker i takes updates on 127.0.0.1:WORKER_BASE_PORT + i
+WORKER_QUEUE_SIZE = 10000  # Updates buffered per worker before the supervisor answers 503
+SHARED_STATE_INTERVAL = 5  # Seconds between checks for channel/cache changes made by other workers
+PROFILE_DEFAULT_SECONDS = 20  # Length of a /profile capture when none is given
+PROFILE_MAX_SECONDS = 120  # Longest capture allowed; cProfile slows Python code while it runs
+PROFILE_TRACE_FRAMES = 1  # Stack frames tracemalloc keeps per allocation; more costs more
+PROFILE_REPORT_LINES = 25  # Entries per section of the profile report
+ARCHIVE_INACTIVE_DAYS = 90  # Users idle this long (or who blocked the bot) move to users_archive
+ARCHIVE_INTERVAL = 3600  # Seconds between archival passes
+ARCHIVE_BATCH = 1000  # Users moved per archival transaction
+ACTIVITY_FLUSH_INTERVAL = 60  # Seconds between batched last_active_at updates
+
+# Images sent to every user: (image URL, overlay text)
+WELCOME_IMAGE = (f"{DOMAIN}/images/welcome.jpg", "Welcome!")
+VERIFICATION_IMAGE = (f"{DOMAIN}/images/verification.jpg", f"Code: {VERIFICATION_CODE}")
+
+DB_PATH = 'bot.db'
+DB_READ_POOL_SIZE = 4  # Reader threads; all writes go through a single writer thread
+DB_STATEMENT_CACHE_SIZE = 256  # Prepared statements kept per connection
+
+# Worker identity
+class WorkerIdentity:
+    # Which worker this process is in supervisor mode; a standalone bot is
+    # worker 0 of 1. Worker 0 is the leader and alone sends broadcasts.
+    def __init__(self):
+        self.index = 0
+        self.count = 1
+
+    @property
+    def leader(self):
+        return self.index == 0
+
+    @property
+    def sharded(self):
+        return self.count > 1
+
+worker = WorkerIdentity()
+
+# Metrics
+# Latency histograms and counters for handlers, storage helpers and Bot API
+# calls. With METRICS_ENABLED off, timed() returns functions untouched and
+# the Bot API request class is not replaced, so there is no overhead.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Metric kind -> Prometheus label name
+METRIC_LABELS = {'handler': 'handler', 'db': 'query', 'api': 'method'}
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        # Linear interpolation inside the bucket holding the q-th observation
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        lower = 0.0
+        for i, bucket_count in enumerate(self.buckets):
+            upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else LATENCY_BUCKETS[-1] * 2
+            if bucket_count and seen + bucket_count >= target:
+                return lower + (upper - lower) * (target - seen) / bucket_count
+            seen += bucket_count
+            lower = upper
+        return lower
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def observe(self, kind, name, seconds):
+        histogram = self.histograms.get((kind, name))
+        if histogram is None:
+            histogram = self.histograms[(kind, name)] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, kind, counter, name, amount=1):
+        key = (kind, counter, name)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def render_prometheus(self):
+        lines = []
+        for kind, label in METRIC_LABELS.items():
+            family = f"bot_{kind}_seconds"
+            lines.append(f"# TYPE {family} histogram")
+            for (hist_kind, name), histogram in sorted(self.histograms.items()):
+                if hist_kind != kind:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS, histogram.buckets):
+                    cumulative += bucket_count
+                    lines.append(f'{family}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{family}_bucket{{{label}="{name}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{family}_sum{{{label}="{name}"}} {histogram.sum:.6f}')
+                lines.append(f'{family}_count{{{label}="{name}"}} {histogram.count}')
+        for counter in ('errors', 'retry_after', 'throttled', 'shed'):
+            for kind, label in METRIC_LABELS.items():
+                family = f"bot_{kind}_{counter}_total"
+                rows = [(name, value) for (c_kind, c_counter, name), value in sorted(self.counters.items())
+                        if c_kind == kind and c_counter == counter]
+                if rows:
+                    lines.append(f"# TYPE {family} counter")
+                    lines.extend(f'{family}{{{label}="{name}"}} {value}' for name, value in rows)
+        return "\n".join(lines) + "\n"
+
+    def summary(self, limit=8):
+        uptime = int(time.time() - self.started)
+        sections = [f"📈 Metrics (uptime {uptime // 3600}h {uptime % 3600 // 60}m)"]
+        titles = {'handler': "Handlers", 'db': "Storage", 'api': "Bot API"}
+        for kind, title in titles.items():
+            rows = sorted(
+                ((name, h) for (h_kind, name), h in self.histograms.items() if h_kind == kind),
+                key=lambda row: row[1].quantile(0.95),
+                reverse=True
+            )[:limit]
+            if not rows:
+                continue
+            sections.append(f"\n{title} (slowest p95 first):")
+            for name, histogram in rows:
+                errors = self.counters.get((kind, 'errors', name), 0)
+                throttled = self.counters.get((kind, 'retry_after', name), 0)
+                dropped = (self.counters.get((kind, 'throttled', name), 0)
+                           + self.counters.get((kind, 'shed', name), 0))
+                line = (f"{name}: {histogram.count} calls, p50 {histogram.quantile(0.5) * 1000:.0f}ms, "
+                        f"p95 {histogram.quantile(0.95) * 1000:.0f}ms")
+                if errors:
+                    line += f", {errors} errors"
+                if throttled:
+                    line += f", {throttled}× 429"
+                if dropped:
+                    line += f", {dropped} dropped"
+                sections.append(line)
+        return "\n".join(sections)
+
+metrics = Metrics()
+
+def timed(kind, name=None):
+    # Decorator for coroutine functions recording latency, errors and RetryAfter
+    def decorator(fn):
+        if not METRICS_ENABLED:
+            return fn
+        label = name or fn.__name__
+        
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except RetryAfter:
+                metrics.inc(kind, 'retry_after', label)
+                raise
+            except Exception:
+                metrics.inc(kind, 'errors', label)
+                raise
+            finally:
+                metrics.observe(kind, label, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+class InstrumentedRequest(HTTPXRequest):
+    # Times every Bot API call made through context.bot
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            metrics.inc('api', 'errors', endpoint)
+            raise
+        finally:
+            metrics.observe('api', endpoint, time.perf_counter() - started)
+        if code == 429:
+            metrics.inc('api', 'retry_after', endpoint)
+        elif code >= 400:
+            metrics.inc('api', 'errors', endpoint)
+        return code, payload
+
+class MetricsServer:
+    # Local Prometheus-style text endpoint
+    def __init__(self):
+        self.runner = None
+
+    async def start(self, host=METRICS_HOST, port=METRICS_PORT):
+        if not METRICS_ENABLED:
+            return
+        
+        async def handle_metrics(request):
+            return web.Response(text=metrics.render_prometheus(), content_type='text/plain')
+        
+        web_app = web.Application()
+        web_app.router.add_get('/metrics', handle_metrics)
+        self.runner = web.AppRunner(web_app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info(f"Metrics available on http://{host}:{port}/metrics")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+metrics_server = MetricsServer()
+
+# Storage layer
+# Every query runs on a long-lived connection owned by a DB thread so that
+# sqlite never blocks the event loop. Writes are serialized on one writer
+# thread, reads are spread over a small pool of read-only connections (WAL
+# lets them run alongside the writer).
+class Storage:
+    def __init__(self, path, readers=DB_READ_POOL_SIZE):
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.ready = False  # Set once init_db has run against this database
+
+    def _connect(self, read_only):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if read_only:
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def _connection(self, read_only):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect(read_only)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _run(self, fn, args, read_only):
+        conn = self._connection(read_only)
+        if read_only:
+            return fn(conn, *args)
+        with conn:
+            # sqlite3 would only BEGIN at the first INSERT/UPDATE/DELETE;
+            # IMMEDIATE takes the write lock up front, so the counts and
+            # candidate SELECTs a write function runs first cannot go stale
+            # under another worker process writing at the same time
+            conn.execute("BEGIN IMMEDIATE")
+            return fn(conn, *args)
+
+    async def read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run, fn, args, True)
+
+    async def write(self, fn, *args):
+        # fn(conn, *args) runs inside a single transaction on the writer thread
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._run, fn, args, False)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.write(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def executescript(self, script):
+        return await self.write(lambda conn: conn.executescript(script))
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+db = Storage(DB_PATH)
 
 # Database setup
-def init_db():
-    conn = sqlite3.connect('bot.db')
-    cursor = conn.cursor()
-    
-    # Users table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        first_name TEXT,
-        last_name TEXT,
-        joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        verified INTEGER DEFAULT 0,
-        code_sent INTEGER DEFAULT 0,
-        upi_sent INTEGER DEFAULT 0
-    )
-    ''')
-    
-    # Channels table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS channels (
-        channel_id INTEGER PRIMARY KEY,
-        username TEXT,
-        title TEXT,
-        invite_link TEXT,
-        is_private INTEGER DEFAULT 0,
-        required INTEGER DEFAULT 1,
-        sequence INTEGER
-    )
-    ''')
-    
-    # Payments table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS payments (
-        payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        upi_id TEXT,
-        amount REAL,
-        status TEXT,
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    conn.commit()
-    conn.close()
-
-# Database functions
-def get_db_connection():
-    return sqlite3.connect('bot.db')
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    verified INTEGER DEFAULT 0,
+    code_sent INTEGER DEFAULT 0,
+    upi_sent INTEGER DEFAULT 0,
+    blocked INTEGER DEFAULT 0,
+    funnel_state TEXT DEFAULT 'new',
+    last_active_at DATETIME
+);
+
+CREATE TABLE IF NOT EXISTS users_archive (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    joined_at DATETIME,
+    verified INTEGER,
+    code_sent INTEGER,
+    upi_sent INTEGER,
+    blocked INTEGER,
+    funnel_state TEXT,
+    last_active_at DATETIME,
+    archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id INTEGER PRIMARY KEY,
+    username TEXT,
+    title TEXT,
+    invite_link TEXT,
+    is_private INTEGER DEFAULT 0,
+    required INTEGER DEFAULT 1,
+    sequence INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS payments (
+    payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    upi_id TEXT,
+    amount REAL,
+    status TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS memberships (
+    user_id INTEGER,
+    channel_id INTEGER,
+    status TEXT,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, channel_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS stats_counters (
+    name TEXT PRIMARY KEY,
+    value NUMERIC DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    admin_id INTEGER,
+    from_chat_id INTEGER,
+    message_id INTEGER,
+    status TEXT DEFAULT 'running',
+    total INTEGER DEFAULT 0,
+    sent INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0,
+    blocked INTEGER DEFAULT 0,
+    progress_chat_id INTEGER,
+    progress_message_id INTEGER,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    finished_at DATETIME,
+    segment TEXT DEFAULT 'all'
+);
+
+CREATE TABLE IF NOT EXISTS image_cache (
+    cache_key TEXT PRIMARY KEY,
+    image_url TEXT,
+    overlay_text TEXT,
+    source_validator TEXT,
+    rendered BLOB,
+    file_id TEXT,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_recipients (
+    job_id INTEGER,
+    user_id INTEGER,
+    status TEXT DEFAULT 'pending',
+    PRIMARY KEY (job_id, user_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT
+);
+
+CREATE TABLE IF NOT EXISTS warm_state (
+    name TEXT PRIMARY KEY,
+    value BLOB,
+    saved_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS funnel_daily (
+    day TEXT,
+    event TEXT,
+    count INTEGER DEFAULT 0,
+    PRIMARY KEY (day, event)
+) WITHOUT ROWID;
+'''
+
+# Columns added after the first release; (table, column, declaration, backfill SQL)
+COLUMN_MIGRATIONS = [
+    ('users', 'blocked', 'INTEGER DEFAULT 0', None),
+    ('users', 'funnel_state', "TEXT DEFAULT 'new'", '''
+        UPDATE users SET funnel_state = CASE
+            WHEN EXISTS (SELECT 1 FROM payments WHERE payments.user_id = users.user_id) THEN 'awaiting_payment'
+            WHEN upi_sent = 1 THEN 'code_verified'
+            WHEN code_sent = 1 THEN 'joined'
+            ELSE 'new'
+        END
+    '''),
+    ('broadcast_jobs', 'segment', "TEXT DEFAULT 'all'", None),
+    # sqlite cannot add a column defaulting to CURRENT_TIMESTAMP; inserts set it
+    ('users', 'last_active_at', 'DATETIME', "UPDATE users SET last_active_at = joined_at"),
+]
+
+# Created after migrations so they may reference migrated columns
+INDEXES = '''
+CREATE INDEX IF NOT EXISTS idx_users_verified ON users(verified);
+CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status);
+CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id);
+CREATE INDEX IF NOT EXISTS idx_payments_created ON payments(created_at);
+CREATE INDEX IF NOT EXISTS idx_payments_status_user ON payments(status, user_id);
+CREATE INDEX IF NOT EXISTS idx_users_joined ON users(joined_at);
+CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active_at);
+CREATE INDEX IF NOT EXISTS idx_users_blocked ON users(user_id) WHERE blocked = 1;
+CREATE INDEX IF NOT EXISTS idx_users_archive_archived ON users_archive(archived_at);
+'''
+
+def _apply_migrations(conn):
+    for table, column, declaration, backfill in COLUMN_MIGRATIONS:
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+            if backfill:
+                conn.execute(backfill)
+
+async def init_db():
+    # Persistence loads before post_init, so whichever runs first sets up the schema
+    if db.ready:
+        return
+    await db.executescript(SCHEMA)
+    await db.write(_apply_migrations)
+    await db.executescript(INDEXES)
+    await db.write(_backfill_counters)
+    await db.write(_backfill_rollups)
+    await db.write(_purge_broadcast_recipients)
+    db.ready = True
+
+# Aggregate counters
+# stats_counters holds running totals for the stats panel. Every write that
+# changes one of them bumps it in the same transaction, so reading stats
+# never scans users or payments.
+def _bump_counter(conn, name, delta):
+    if delta:
+        conn.execute(
+            "INSERT INTO stats_counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, delta)
+        )
+
+def _bump_payment_counters(conn, status, count, amount):
+    _bump_counter(conn, f"payments:{status}", count)
+    _bump_counter(conn, f"revenue:{status}", amount)
+
+def _backfill_counters(conn):
+    # One-off full count for databases created before the counters existed
+    if conn.execute("SELECT COUNT(*) FROM stats_counters").fetchone()[0]:
+        return
+    archived = conn.execute("SELECT COUNT(*) FROM users_archive").fetchone()[0]
+    counters = {
+        'users': conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] + archived,
+        'verified_users': conn.execute("SELECT COUNT(*) FROM users WHERE verified = 1").fetchone()[0]
+            + conn.execute("SELECT COUNT(*) FROM users_archive WHERE verified = 1").fetchone()[0],
+        'archived_users': archived,
+    }
+    for status, count, revenue in conn.execute(
+        "SELECT status, COUNT(*), COALESCE(SUM(amount), 0) FROM payments GROUP BY status"
+    ):
+        counters[f"payments:{status}"] = count
+        counters[f"revenue:{status}"] = revenue
+    conn.executemany("INSERT INTO stats_counters (name, value) VALUES (?, ?)", counters.items())
+
+# Daily rollups
+# funnel_daily counts funnel events per UTC day, bumped in the same
+# transaction as the event itself, so trend charts read a few dozen rows
+# instead of scanning users and payments.
+FUNNEL_EVENTS = ('joins', 'verified', 'codes', 'payments')
+
+def _bump_daily(conn, event, delta):
+    if delta:
+        conn.execute(
+            "INSERT INTO funnel_daily (day, event, count) VALUES (date('now'), ?, ?) "
+            "ON CONFLICT(day, event) DO UPDATE SET count = count + excluded.count",
+            (event, delta)
+        )
+
+def _backfill_rollups(conn):
+    # Joins and payments can be rebuilt from their timestamps; verifications
+    # and code submissions were never timestamped, so they start from today
+    if conn.execute("SELECT 1 FROM funnel_daily LIMIT 1").fetchone():
+        return
+    conn.execute(
+        "INSERT INTO funnel_daily (day, event, count) "
+        "SELECT date(joined_at), 'joins', COUNT(*) FROM users WHERE joined_at IS NOT NULL GROUP BY 1"
+    )
+    conn.execute(
+        "INSERT INTO funnel_daily (day, event, count) "
+        "SELECT date(created_at), 'payments', COUNT(*) FROM payments WHERE created_at IS NOT NULL GROUP BY 1"
+    )
+
+# Channel management functions
+class ChannelRegistry:
+    # Process-wide copy of the channels table with prebuilt keyboards. It is
+    # only reloaded by add_channel, delete_channel and update_channel_sequence
+    # (or, in supervisor mode, when another worker ran one of them), so /start
+    # never reads channels from the database.
+    def __init__(self):
+        self.channels = []
+        self.channel_ids = frozenset()
+        self.join_keyboard = None
+        self.admin_keyboard = None
+
+    @timed('db', 'load_channels')
+    async def load(self):
+        channels = await db.fetchall("SELECT * FROM channels ORDER BY sequence")
+        self.join_keyboard = self._build_join_keyboard(channels)
+        self.admin_keyboard = self._build_admin_keyboard(channels)
+        self.channel_ids = frozenset(channel[0] for channel in channels)
+        self.channels = channels
+
+    @staticmethod
+    def _build_join_keyboard(channels):
+        keyboard = []
+        
+        for channel in channels:
+            channel_id, username, title, invite_link, is_private, required, sequence = channel
+            keyboard.append([InlineKeyboardButton(title, url=invite_link)])
+        
+        keyboard.append([InlineKeyboardButton("✅ I've Joined All", callback_data="verify_join")])
+        return InlineKeyboardMarkup(keyboard)
+
+    @staticmethod
+    def _build_admin_keyboard(channels):
+        keyboard = []
+        
+        for channel in channels:
+            channel_id, username, title, invite_link, is_private, required, sequence = channel
+            keyboard.append([
+                InlineKeyboardButton(f"❌ {title}", callback_data=f"delete_channel_{channel_id}"),
+                InlineKeyboardButton("⬆️", callback_data=f"move_up_{channel_id}"),
+                InlineKeyboardButton("⬇️", callback_data=f"move_down_{channel_id}")
+            ])
+        
+        keyboard.append([InlineKeyboardButton("➕ Add Channel", callback_data="add_channel")])
+        keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="admin_back")])
+        return InlineKeyboardMarkup(keyboard)
+
+channel_registry = ChannelRegistry()
+
+def get_channels():
+    return channel_registry.channels
+
+def _insert_channel(conn, channel_id, username, title, invite_link, is_private):
+    # Get the next sequence number
+    max_seq = conn.execute("SELECT MAX(sequence) FROM channels").fetchone()[0]
+    sequence = max_seq + 1 if max_seq is not None else 1
+    
+    conn.execute(
+        "INSERT INTO channels (channel_id, username, title, invite_link, is_private, sequence) VALUES (?, ?, ?, ?, ?, ?)",
+        (channel_id, username, title, invite_link, is_private, sequence)
+    )
+    _bump_counter(conn, 'channels_version', 1)
+
+@timed('db')
+async def add_channel(channel_id, username, title, invite_link, is_private):
+    await db.write(_insert_channel, channel_id, username, title, invite_link, is_private)
+    await channel_registry.load()
+
+def _delete_channel(conn, channel_id):
+    conn.execute("DELETE FROM channels WHERE channel_id = ?", (channel_id,))
+    conn.execute("DELETE FROM memberships WHERE channel_id = ?", (channel_id,))
+    _bump_counter(conn, 'channels_version', 1)
+
+@timed('db')
+async def delete_channel(channel_id):
+    await db.write(_delete_channel, channel_id)
+    await channel_registry.load()
+
+def _set_channel_sequence(conn, channel_id, new_sequence):
+    conn.execute("UPDATE channels SET sequence = ? WHERE channel_id = ?", (new_sequence, channel_id))
+    _bump_counter(conn, 'channels_version', 1)
+
+@timed('db')
+async def update_channel_sequence(channel_id, new_sequence):
+    await db.write(_set_channel_sequence, channel_id, new_sequence)
+    await channel_registry.load()
+
+# User management functions
+def _insert_users(conn, rows):
+    # Archived users come back with their history rather than as new users
+    _restore_users(conn, [row[0] for row in rows])
+    inserted = conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, last_active_at) "
+        "VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
+        rows
+    ).rowcount
+    _bump_counter(conn, 'users', inserted)
+    _bump_daily(conn, 'joins', inserted)
+
+@timed('db')
+async def add_users(rows):
+    # rows: (user_id, username, first_name, last_name), inserted in one transaction
+    await db.write(_insert_users, rows)
+
+def _set_user_verification(conn, user_id, verified):
+    changed = conn.execute(
+        "UPDATE users SET verified = ? WHERE user_id = ? AND verified IS NOT ?",
+        (verified, user_id, verified)
+    ).rowcount
+    _bump_counter(conn, 'verified_users', changed if verified else -changed)
+    if verified:
+        _bump_daily(conn, 'verified', changed)
+
+@timed('db')
+async def update_user_verification(user_id, verified):
+    await db.write(_set_user_verification, user_id, verified)
+
+@timed('db')
+async def get_user_funnel_state(user_id):
+    row = await db.fetchone("SELECT funnel_state FROM users WHERE user_id = ?", (user_id,))
+    return row[0] if row else None
+
+def _set_user_funnel_state(conn, user_id, state):
+    # The legacy code_sent/upi_sent flags are kept in step with the state
+    step = FUNNEL_STATES.index(state)
+    changed = conn.execute(
+        "UPDATE users SET funnel_state = ?, code_sent = ?, upi_sent = ? WHERE user_id = ? AND funnel_state IS NOT ?",
+        (state, int(step >= 1), int(step >= 2), user_id, state)
+    ).rowcount
+    if state == 'code_verified':
+        _bump_daily(conn, 'codes', changed)
+
+@timed('db')
+async def update_user_funnel_state(user_id, state):
+    await db.write(_set_user_funnel_state, user_id, state)
+
+def _touch_users(conn, user_ids):
+    # Anyone who messaged or tapped a button since the last flush is active and
+    # has not blocked the bot
+    conn.executemany(
+        "UPDATE users SET last_active_at = CURRENT_TIMESTAMP, blocked = 0 WHERE user_id = ?",
+        [(user_id,) for user_id in user_ids]
+    )
+
+@timed('db')
+async def touch_users(user_ids):
+    await db.write(_touch_users, user_ids)
+
+@timed('db')
+async def set_user_blocked(user_id, blocked):
+    await db.execute("UPDATE users SET blocked = ? WHERE user_id = ?", (int(blocked), user_id))
+
+# User archive functions
+# Cold users (blocked, or idle for ARCHIVE_INACTIVE_DAYS) are moved from users
+# to users_archive in batches so the hot table, its indexes and every scan
+# over it stay small. Payments keep their user_id and join either table.
+# Totals in stats_counters still include archived users.
+USER_COLUMNS = (
+    "user_id, username, first_name, last_name, joined_at, verified, code_sent, upi_sent, "
+    "blocked, funnel_state, last_active_at"
+)
+
+def _restore_users(conn, user_ids):
+    params = [(user_id,) for user_id in user_ids]
+    restored = conn.executemany(
+        f"INSERT OR IGNORE INTO users ({USER_COLUMNS}) SELECT {USER_COLUMNS} FROM users_archive WHERE user_id = ?",
+        params
+    ).rowcount
+    if restored:
+        conn.executemany("DELETE FROM users_archive WHERE user_id = ?", params)
+        conn.executemany(
+            "UPDATE users SET last_active_at = CURRENT_TIMESTAMP, blocked = 0 WHERE user_id = ?",
+            params
+        )
+        _bump_counter(conn, 'archived_users', -restored)
+    return restored
+
+def _restore_user(conn, user_id):
+    _restore_users(conn, [user_id])
+    row = conn.execute("SELECT funnel_state FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else None
+
+@timed('db')
+async def restore_archived_user(user_id):
+    # Returns the restored user's funnel state, or None if they are not archived
+    if not await db.fetchone("SELECT 1 FROM users_archive WHERE user_id = ?", (user_id,)):
+        return None
+    return await db.write(_restore_user, user_id)
+
+def _archive_users(conn, inactive_days, limit):
+    # Blocked users first (partial index), then the longest idle
+    user_ids = [row[0] for row in conn.execute(
+        "SELECT user_id FROM users WHERE blocked = 1 LIMIT ?", (limit,)
+    )]
+    if len(user_ids) < limit:
+        user_ids += [row[0] for row in conn.execute(
+            "SELECT user_id FROM users WHERE last_active_at < datetime('now', ?) AND blocked = 0 "
+            "ORDER BY last_active_at LIMIT ?",
+            (f"-{inactive_days} days", limit - len(user_ids))
+        )]
+    if not user_ids:
+        return []
+    params = [(user_id,) for user_id in user_ids]
+    conn.executemany(
+        f"INSERT OR REPLACE INTO users_archive ({USER_COLUMNS}) SELECT {USER_COLUMNS} FROM users WHERE user_id = ?",
+        params
+    )
+    conn.executemany("DELETE FROM users WHERE user_id = ?", params)
+    conn.executemany("DELETE FROM memberships WHERE user_id = ?", params)
+    _bump_counter(conn, 'archived_users', len(user_ids))
+    # Other workers drop their cached view of users when this moves
+    _bump_counter(conn, 'archive_version', 1)
+    return user_ids
+
+@timed('db')
+async def archive_users_batch(inactive_days=ARCHIVE_INACTIVE_DAYS, limit=ARCHIVE_BATCH):
+    # Moves one batch in one transaction; returns the archived user ids
+    return await db.write(_archive_users, inactive_days, limit)
+
+@timed('db')
+async def get_latest_archive_time():
+    row = await db.fetchone("SELECT COALESCE(MAX(archived_at), '') FROM users_archive")
+    return row[0]
+
+@timed('db')
+async def get_archived_since(since):
+    # Returns ([user_id], newest archived_at) for users archived at or after since.
+    # archived_at has one-second resolution, so the last second is read again next time.
+    rows = await db.fetchall(
+        "SELECT user_id, archived_at FROM users_archive WHERE archived_at >= ? ORDER BY archived_at",
+        (since,)
+    )
+    return [row[0] for row in rows], (rows[-1][1] if rows else since)
+
+# Membership index functions
+@timed('db')
+async def get_indexed_memberships(user_id, max_age=MEMBERSHIP_INDEX_MAX_AGE):
+    # Returns {channel_id: status} for every channel with data updated in the last max_age seconds
+    rows = await db.fetchall(
+        "SELECT channel_id, status FROM memberships WHERE user_id = ? AND updated_at >= datetime('now', ?)",
+        (user_id, f"-{max_age} seconds")
+    )
+    return dict(rows)
+
+@timed('db')
+async def record_memberships(rows):
+    # rows: (user_id, channel_id, status)
+    await db.executemany(
+        "INSERT INTO memberships (user_id, channel_id, status) VALUES (?, ?, ?) "
+        "ON CONFLICT(user_id, channel_id) DO UPDATE SET status = excluded.status, updated_at = CURRENT_TIMESTAMP",
+        rows
+    )
+
+# Payment functions
+def _insert_payment(conn, user_id, upi_id, amount):
+    conn.execute(
+        "INSERT INTO payments (user_id, upi_id, amount, status) VALUES (?, ?, ?, ?)",
+        (user_id, upi_id, amount, 'pending')
+    )
+    _bump_payment_counters(conn, 'pending', 1, amount)
+    _bump_daily(conn, 'payments', 1)
+
+@timed('db')
+async def add_payment(user_id, upi_id, amount):
+    await db.write(_insert_payment, user_id, upi_id, amount)
+
+# Pending payments are paged by payment_id (keyset pagination) through the
+# status index, so every page costs the same however many
+# payments have been reviewed already
+PENDING_PAYMENT_COLUMNS = '''
+    SELECT p.payment_id, p.user_id, COALESCE(u.username, a.username), p.upi_id, p.amount, p.created_at
+    FROM payments p
+    LEFT JOIN users u ON u.user_id = p.user_id
+    LEFT JOIN users_archive a ON a.user_id = p.user_id
+'''
+
+@timed('db')
+async def get_pending_payments_after(after_id, limit):
+    return await db.fetchall(
+        PENDING_PAYMENT_COLUMNS + "WHERE p.status = 'pending' AND p.payment_id > ? ORDER BY p.payment_id LIMIT ?",
+        (after_id, limit)
+    )
+
+@timed('db')
+async def get_pending_payments_before(before_id, limit):
+    rows = await db.fetchall(
+        PENDING_PAYMENT_COLUMNS + "WHERE p.status = 'pending' AND p.payment_id < ? ORDER BY p.payment_id DESC LIMIT ?",
+        (before_id, limit)
+    )
+    return rows[::-1]
+
+@timed('db')
+async def has_pending_payment_before(payment_id):
+    row = await db.fetchone(
+        "SELECT 1 FROM payments WHERE status = 'pending' AND payment_id < ? LIMIT 1",
+        (payment_id,)
+    )
+    return row is not None
+
+def _set_pending_range_status(conn, first_id, last_id, status):
+    # A page is a contiguous run of pending ids, so the range covers exactly what the admin saw
+    count, amount = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM payments "
+        "WHERE status = 'pending' AND payment_id BETWEEN ? AND ?",
+        (first_id, last_id)
+    ).fetchone()
+    conn.execute(
+        "UPDATE payments SET status = ? WHERE status = 'pending' AND payment_id BETWEEN ? AND ?",
+        (status, first_id, last_id)
+    )
+    _bump_payment_counters(conn, 'pending', -count, -amount)
+    _bump_payment_counters(conn, status, count, amount)
+    return count
+
+@timed('db')
+async def set_pending_payments_status(first_id, last_id, status):
+    # Bulk approve/reject in a single transaction; returns the number of payments changed
+    return await db.write(_set_pending_range_status, first_id, last_id, status)
+
+# Broadcast functions
+BROADCAST_JOB_COLUMNS = (
+    "job_id, admin_id, from_chat_id, message_id, status, total, sent, failed, blocked, "
+    "progress_chat_id, progress_message_id"
+)
+
+# Broadcast audiences: segment key -> (button label, query for its user ids).
+# Each query is served by an index (verified, joined_at, payments(status,
+# user_id)), so resolving a segment costs time in proportion to its size.
+# Blocked users are never targeted.
+BROADCAST_SEGMENTS = {
+    'all': ("Everyone", "SELECT user_id FROM users WHERE blocked = 0"),
+    'verified': ("Verified users", "SELECT user_id FROM users WHERE verified = 1 AND blocked = 0"),
+    'pending': ("Pending payment", '''
+        SELECT DISTINCT p.user_id FROM payments p JOIN users u ON u.user_id = p.user_id
+        WHERE p.status = 'pending' AND u.blocked = 0
+    '''),
+    'paid': ("Completed payment", '''
+        SELECT DISTINCT p.user_id FROM payments p JOIN users u ON u.user_id = p.user_id
+        WHERE p.status = 'completed' AND u.blocked = 0
+    '''),
+    'joined7': ("Joined in the last 7 days", "SELECT user_id FROM users WHERE joined_at >= datetime('now', '-7 days') AND blocked = 0"),
+    'joined30': ("Joined in the last 30 days", "SELECT user_id FROM users WHERE joined_at >= datetime('now', '-30 days') AND blocked = 0"),
+}
+# Custom join date ranges are stored as 'joined:<first day>:<last day>'
+JOINED_RANGE_QUERY = "SELECT user_id FROM users WHERE joined_at >= ? AND joined_at < date(?, '+1 day') AND blocked = 0"
+
+def segment_query(segment):
+    # Returns (label, SQL, params) for a segment key
+    if segment.startswith('joined:'):
+        _, first_day, last_day = segment.split(':')
+        return f"Joined {first_day} to {last_day}", JOINED_RANGE_QUERY, (first_day, last_day)
+    label, sql = BROADCAST_SEGMENTS[segment]
+    return label, sql, ()
+
+def _insert_broadcast_job(conn, admin_id, from_chat_id, message_id, segment):
+    cursor = conn.execute(
+        "INSERT INTO broadcast_jobs (admin_id, from_chat_id, message_id, segment) VALUES (?, ?, ?, ?)",
+        (admin_id, from_chat_id, message_id, segment)
+    )
+    job_id = cursor.lastrowid
+    # Recipients are materialized inside sqlite straight from the segment
+    # query, never as a Python list; the sender then pages through them
+    _, sql, params = segment_query(segment)
+    total = conn.execute(
+        f"INSERT INTO broadcast_recipients (job_id, user_id) SELECT ?, user_id FROM ({sql})",
+        (job_id, *params)
+    ).rowcount
+    conn.execute("UPDATE broadcast_jobs SET total = ? WHERE job_id = ?", (total, job_id))
+    return job_id
+
+@timed('db')
+async def create_broadcast_job(admin_id, from_chat_id, message_id, segment='all'):
+    return await db.write(_insert_broadcast_job, admin_id, from_chat_id, message_id, segment)
+
+@timed('db')
+async def count_segment_users(segment):
+    _, sql, params = segment_query(segment)
+    row = await db.fetchone(f"SELECT COUNT(*) FROM ({sql})", params)
+    return row[0]
+
+@timed('db')
+async def get_broadcast_job(job_id):
+    return await db.fetchone(
+        f"SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE job_id = ?",
+        (job_id,)
+    )
+
+@timed('db')
+async def get_running_broadcast_jobs():
+    return await db.fetchall(
+        f"SELECT {BROADCAST_JOB_COLUMNS} FROM broadcast_jobs WHERE status = 'running' ORDER BY job_id"
+    )
+
+@timed('db')
+async def set_broadcast_progress_message(job_id, chat_id, message_id):
+    await db.execute(
+        "UPDATE broadcast_jobs SET progress_chat_id = ?, progress_message_id = ? WHERE job_id = ?",
+        (chat_id, message_id, job_id)
+    )
+
+@timed('db')
+async def get_pending_recipients(job_id, after_user_id, limit):
+    rows = await db.fetchall(
+        "SELECT user_id FROM broadcast_recipients WHERE job_id = ? AND status = 'pending' AND user_id > ? "
+        "ORDER BY user_id LIMIT ?",
+        (job_id, after_user_id, limit)
+    )
+    return [row[0] for row in rows]
+
+def _record_broadcast_results(conn, job_id, results):
+    conn.executemany(
+        "UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND user_id = ?",
+        [(status, job_id, user_id) for user_id, status in results]
+    )
+    blocked = [(user_id,) for user_id, status in results if status == 'blocked']
+    conn.executemany("UPDATE users SET blocked = 1 WHERE user_id = ?", blocked)
+    counts = {'sent': 0, 'failed': 0, 'blocked': 0}
+    for user_id, status in results:
+        counts[status] += 1
+    conn.execute(
+        "UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ?, blocked = blocked + ? WHERE job_id = ?",
+        (counts['sent'], counts['failed'], counts['blocked'], job_id)
+    )
+
+@timed('db')
+async def record_broadcast_results(job_id, results):
+    await db.write(_record_broadcast_results, job_id, results)
+
+def _finish_broadcast_job(conn, job_id, status):
+    conn.execute(
+        "UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE job_id = ? AND status = 'running'",
+        (status, job_id)
+    )
+    # Totals live on the job row; the per-recipient rows were only needed to resume
+    conn.execute("DELETE FROM broadcast_recipients WHERE job_id = ?", (job_id,))
+
+@timed('db')
+async def finish_broadcast_job(job_id, status):
+    await db.write(_finish_broadcast_job, job_id, status)
+
+def _purge_broadcast_recipients(conn):
+    # Recipients left behind by jobs that finished before they were deleted on completion
+    conn.execute(
+        "DELETE FROM broadcast_recipients WHERE job_id IN "
+        "(SELECT job_id FROM broadcast_jobs WHERE status != 'running')"
+    )
+
+# Image cache functions
+@timed('db')
+async def get_cached_image(cache_key):
+    return await db.fetchone(
+        "SELECT image_url, overlay_text, source_validator, rendered, file_id FROM image_cache WHERE cache_key = ?",
+        (cache_key,)
+    )
+
+@timed('db')
+async def save_cached_image(cache_key, image_url, text, validator, rendered):
+    await db.execute(
+        "INSERT OR REPLACE INTO image_cache (cache_key, image_url, overlay_text, source_validator, rendered) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (cache_key, image_url, text, validator, rendered)
+    )
+
+@timed('db')
+async def set_cached_image_file_id(cache_key, file_id):
+    await db.execute(
+        "UPDATE image_cache SET file_id = ?, updated_at = CURRENT_TIMESTAMP WHERE cache_key = ?",
+        (file_id, cache_key)
+    )
+
+@timed('db')
+async def get_cached_image_summary():
+    return await db.fetchall(
+        "SELECT image_url, overlay_text, length(rendered), file_id IS NOT NULL, updated_at FROM image_cache ORDER BY image_url"
+    )
+
+def _delete_cached_images(conn, cache_key):
+    # Other workers drop their in-memory copies when the version moves
+    if cache_key is None:
+        conn.execute("DELETE FROM image_cache")
+    else:
+        conn.execute("DELETE FROM image_cache WHERE cache_key = ?", (cache_key,))
+    _bump_counter(conn, 'image_cache_version', 1)
+
+@timed('db')
+async def delete_cached_image(cache_key):
+    await db.write(_delete_cached_images, cache_key)
+
+@timed('db')
+async def clear_cached_images():
+    await db.write(_delete_cached_images, None)
+
+# Persistence functions
+@timed('db')
+async def get_all_user_data():
+    rows = await db.fetchall("SELECT user_id, data FROM user_data")
+    return {user_id: json.loads(data) for user_id, data in rows}
+
+def _save_user_data(conn, rows):
+    conn.executemany(
+        "INSERT INTO user_data (user_id, data) VALUES (?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+        [(user_id, data) for user_id, data in rows if data != '{}']
+    )
+    conn.executemany(
+        "DELETE FROM user_data WHERE user_id = ?",
+        [(user_id,) for user_id, data in rows if data == '{}']
+    )
+
+@timed('db')
+async def save_user_data(rows):
+    # rows: (user_id, JSON data); empty dicts are deleted rather than stored
+    await db.write(_save_user_data, rows)
+
+@timed('db')
+async def delete_user_data(user_id):
+    await db.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+
+@timed('db')
+async def get_warm_state(name):
+    row = await db.fetchone("SELECT value FROM warm_state WHERE name = ?", (name,))
+    return row[0] if row else None
+
+@timed('db')
+async def save_warm_state(items):
+    # items: (name, value)
+    await db.executemany(
+        "INSERT INTO warm_state (name, value) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = excluded.value, saved_at = CURRENT_TIMESTAMP",
+        items
+    )
+
+def _request_profile(conn, index, chat_id, seconds):
+    conn.execute(
+        "INSERT INTO warm_state (name, value) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = excluded.value, saved_at = CURRENT_TIMESTAMP",
+        (f"profile_request:{index}", json.dumps([chat_id, seconds]))
+    )
+    _bump_counter(conn, 'profile_version', 1)
+
+@timed('db')
+async def request_profile(index, chat_id, seconds):
+    # Worker index picks the request up through SharedStateWatcher
+    await db.write(_request_profile, index, chat_id, seconds)
+
+def _claim_warm_state(conn, name):
+    row = conn.execute("SELECT value FROM warm_state WHERE name = ?", (name,)).fetchone()
+    if row:
+        conn.execute("DELETE FROM warm_state WHERE name = ?", (name,))
+    return row[0] if row else None
+
+@timed('db')
+async def claim_profile_request(index):
+    # Returns (chat_id, seconds) of a request for this worker, removing it, or None
+    value = await db.write(_claim_warm_state, f"profile_request:{index}")
+    return json.loads(value) if value else None
+
+# Stats functions
+STATS_COUNTERS = ('users', 'verified_users', 'payments:completed', 'revenue:completed')
+
+@timed('db')
+async def get_counters(names):
+    placeholders = ", ".join("?" * len(names))
+    rows = await db.fetchall(
+        f"SELECT name, value FROM stats_counters WHERE name IN ({placeholders})",
+        tuple(names)
+    )
+    values = dict(rows)
+    return [values.get(name) or 0 for name in names]
+
+@timed('db')
+async def get_stats():
+    # Returns (total_users, verified_users, completed_payments, total_revenue)
+    return await get_counters(STATS_COUNTERS)
+
+@timed('db')
+async def get_funnel_rollups(first_day):
+    # Returns [(day, event, count)] from first_day ('YYYY-MM-DD') on
+    return await db.fetchall(
+        "SELECT day, event, count FROM funnel_daily WHERE day >= ? ORDER BY day, event",
+        (first_day,)
+    )
+
+# User funnel state
+# new -> joined (channels verified, code sent) -> code_verified (asked for
+# UPI) -> awaiting_payment (payment request recorded)
+FUNNEL_STATES = ('new', 'joined', 'code_verified', 'awaiting_payment')
+
+class FunnelStateCache:
+    # Bounded LRU of user_id -> funnel state with write-through to the users
+    # table. None marks users that never sent /start.
+    def __init__(self, maxsize=FUNNEL_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._states = OrderedDict()
+
+    def _remember(self, user_id, state):
+        self._states[user_id] = state
+        self._states.move_to_end(user_id)
+        if len(self._states) > self.maxsize:
+            self._states.popitem(last=False)
+
+    async def get(self, user_id):
+        if user_id in self._states:
+            self._states.move_to_end(user_id)
+            return self._states[user_id]
+        await registrations.ensure_flushed(user_id)
+        state = await get_user_funnel_state(user_id)
+        if state is None:
+            state = await restore_archived_user(user_id)
+        self._remember(user_id, state)
+        return state
+
+    async def set(self, user_id, state):
+        await update_user_funnel_state(user_id, state)
+        self._remember(user_id, state)
+
+    async def advance(self, user_id, state):
+        # Moves registered users forward only; replays of earlier steps keep their progress
+        current = await self.get(user_id)
+        if current is not None and FUNNEL_STATES.index(state) > FUNNEL_STATES.index(current):
+            await self.set(user_id, state)
+
+    def registered(self, user_id):
+        # Drop a cached "unknown user" so the next lookup sees the new row
+        if user_id in self._states and self._states[user_id] is None:
+            del self._states[user_id]
+
+    def forget(self, user_ids):
+        # Archived users must be looked up (and restored) again
+        for user_id in user_ids:
+            self._states.pop(user_id, None)
+
+funnel = FunnelStateCache()
+
+# User registration buffer
+class UserWriteBehind:
+    # /start only queues unknown users here; they are inserted with one
+    # executemany per USER_FLUSH_INTERVAL or USER_FLUSH_BATCH users, and on
+    # shutdown. Code that needs the row to exist calls ensure_flushed first.
+    def __init__(self):
+        self.pending = {}
+        self.known = OrderedDict()
+        self.version = 0  # Bumped whenever ids enter or leave known
+        self._in_flight = {}
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def add(self, user_id, username, first_name, last_name):
+        if user_id in self.known:
+            self.known.move_to_end(user_id)
+            return
+        if user_id in self.pending or user_id in self._in_flight:
+            return
+        self.pending[user_id] = (user_id, username, first_name, last_name)
+        if len(self.pending) >= USER_FLUSH_BATCH:
+            self._wakeup.set()
+
+    async def ensure_flushed(self, user_id):
+        if user_id in self.pending or user_id in self._in_flight:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return
+            self._in_flight, self.pending = self.pending, {}
+            try:
+                await add_users(list(self._in_flight.values()))
+            except Exception as e:
+                logger.error(f"Error saving {len(self._in_flight)} new users: {e}")
+                for user_id, row in self._in_flight.items():
+                    self.pending.setdefault(user_id, row)
+                return
+            finally:
+                batch, self._in_flight = self._in_flight, {}
+            for user_id in batch:
+                self._remember(user_id)
+                funnel.registered(user_id)
+
+    def _remember(self, user_id):
+        self.known[user_id] = True
+        self.version += 1
+        if len(self.known) > KNOWN_USERS_CACHE_SIZE:
+            self.known.popitem(last=False)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), USER_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+registrations = UserWriteBehind()
+
+# User activity and archival
+class UserArchiver:
+    # Records who interacted in memory and writes last_active_at for all of
+    # them once per ACTIVITY_FLUSH_INTERVAL. Every ARCHIVE_INTERVAL the leader
+    # moves cold users to users_archive, one ARCHIVE_BATCH per transaction, and
+    # forgets them in the local caches so their next /start or message
+    # restores them.
+    def __init__(self):
+        self.active = set()
+        self._tasks = []
+
+    def touch(self, user_id):
+        self.active.add(user_id)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._flush_loop())]
+        if worker.leader:
+            self._tasks.append(asyncio.create_task(self._archive_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    async def flush(self):
+        if not self.active:
+            return
+        user_ids, self.active = self.active, set()
+        await touch_users(list(user_ids))
+
+    def forget(self, user_ids):
+        for user_id in user_ids:
+            if registrations.known.pop(user_id, None):
+                registrations.version += 1
+        funnel.forget(user_ids)
+
+    async def archive(self):
+        # Returns the number of users moved; batches yield to other writes in between
+        await self.flush()
+        moved = 0
+        while True:
+            user_ids = await archive_users_batch()
+            self.forget(user_ids)
+            moved += len(user_ids)
+            if len(user_ids) < ARCHIVE_BATCH:
+                break
+            await asyncio.sleep(0)
+        if moved:
+            logger.info(f"Archived {moved} inactive or blocked users")
+        return moved
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error saving user activity: {e}")
+
+    async def _archive_loop(self):
+        while True:
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+            try:
+                await self.archive()
+            except Exception as e:
+                logger.error(f"Error archiving users: {e}")
+
+archiver = UserArchiver()
+
+# Membership verification
+NOT_MEMBER_STATUSES = ('left', 'kicked')
+
+def is_not_modified(error):
+    # Editing a message to the text it already has; every other BadRequest is a real failure
+    return 'not modified' in str(error).lower()
+
+def shorten(text, limit):
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+def retry_after_seconds(error):
+    # RetryAfter.retry_after is an int or a timedelta depending on the library version
+    if isinstance(error.retry_after, timedelta):
+        return error.retry_after.total_seconds()
+    return float(error.retry_after)
+
+async def get_member_status(bot, channel_id, user_id):
+    # Returns the member status, 'left' when Telegram rejects the lookup,
+    # or None when the status could not be determined after retries
+    delay = 1
+    for attempt in range(MEMBERSHIP_CHECK_RETRIES + 1):
+        last_attempt = attempt == MEMBERSHIP_CHECK_RETRIES
+        try:
+            member = await bot.get_chat_member(channel_id, user_id)
+            return member.status
+        except BadRequest:
+            return 'left'
+        except RetryAfter:
+            # The outbound scheduler already waited and retried
+            break
+        except NetworkError as e:
+            if last_attempt:
+                break
+            logger.warning(f"Network error checking membership in {channel_id}: {e}")
+            await asyncio.sleep(delay)
+            delay *= 2
+        except Exception as e:
+            logger.error(f"Error checking membership: {e}")
+            return None
+    logger.warning(f"Gave up checking membership of {user_id} in {channel_id}")
+    return None
+
+async def check_memberships(bot, user_id, channels,
+                            concurrency=MEMBERSHIP_CHECK_CONCURRENCY,
+                            stop_on_first_missing=MEMBERSHIP_STOP_ON_FIRST_MISSING):
+    # Returns (not_joined, unchecked) channel titles, in channel order.
+    # Memberships seen through chat_member updates answer without a Bot API
+    # call. Only recent positive entries are trusted: a user may have joined
+    # or left while the bot was down or missed their chat_member update, so
+    # missing, non-member and stale pairs are asked for.
+    statuses = {
+        channel_id: status
+        for channel_id, status in (await get_indexed_memberships(user_id)).items()
+        if status not in NOT_MEMBER_STATUSES
+    }
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def check(channel):
+        async with semaphore:
+            return await get_member_status(bot, channel[0], user_id)
+    
+    tasks = {
+        asyncio.create_task(check(channel)): channel
+        for channel in channels
+        if channel[0] not in statuses
+    }
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                statuses[tasks[task][0]] = task.result()
+            if stop_on_first_missing and any(
+                statuses[tasks[task][0]] in NOT_MEMBER_STATUSES for task in done
+            ):
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+    
+    fetched = [
+        (user_id, channel[0], statuses[channel[0]])
+        for task, channel in tasks.items()
+        if statuses.get(channel[0]) is not None
+    ]
+    if fetched:
+        await record_memberships(fetched)
+    
+    not_joined = []
+    unchecked = []
+    for channel in channels:
+        channel_id, title = channel[0], channel[2]
+        if channel_id not in statuses:
+            continue
+        status = statuses[channel_id]
+        if status is None:
+            unchecked.append(title)
+        elif status in NOT_MEMBER_STATUSES:
+            not_joined.append(title)
+    return not_joined, unchecked
+
+# Broadcast engine
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def try_acquire(self):
+        # Non-blocking variant: takes a token only if one is available right now
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class BroadcastRun:
+    def __init__(self, job):
+        (self.job_id, self.admin_id, self.from_chat_id, self.message_id, self.status,
+         self.total, self.sent, self.failed, self.blocked,
+         self.progress_chat_id, self.progress_message_id) = job
+        self.cancelled = False
+        self.results = []
+        self.task = None
+
+def broadcast_progress_text(job_id, status, total, sent, failed, blocked):
+    done = sent + failed + blocked
+    if status == 'completed':
+        header = f"Broadcast #{job_id} completed!"
+    elif status == 'cancelled':
+        header = f"Broadcast #{job_id} cancelled."
+    elif status == 'failed':
+        header = f"Broadcast #{job_id} stopped after an error."
+    else:
+        header = f"Broadcast #{job_id} in progress..."
+    return f"{header}\nProgress: {done}/{total}\nSuccess: {sent}\nFailed: {failed}\nBlocked: {blocked}"
+
+def broadcast_job_keyboard(job_id, status):
+    if status != 'running':
+        return None
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("🔄 Refresh", callback_data=f"bcast_status_{job_id}"),
+        InlineKeyboardButton("⛔ Cancel", callback_data=f"bcast_cancel_{job_id}")
+    ]])
+
+class BroadcastManager:
+    # Jobs and per-recipient progress live in the database, so a restart
+    # resumes every job still marked 'running' where it left off.
+    def __init__(self):
+        self.runs = {}
+        self.bucket = TokenBucket(BROADCAST_RATE)
+
+    async def start(self, bot, admin_id, from_chat_id, message_id, segment='all'):
+        job_id = await create_broadcast_job(admin_id, from_chat_id, message_id, segment)
+        job = await get_broadcast_job(job_id)
+        if not worker.leader:
+            # Only the leader worker sends; it picks the job up from the database
+            return BroadcastRun(job)
+        return self._launch(bot, job)
+
+    async def resume(self, bot):
+        for job in await get_running_broadcast_jobs():
+            if job[0] in self.runs:
+                continue
+            logger.info(f"Resuming broadcast #{job[0]}")
+            self._launch(bot, job)
+
+    async def watch(self, bot):
+        # Leader worker in supervisor mode: launch jobs created by other workers
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            try:
+                await self.resume(bot)
+            except Exception as e:
+                logger.error(f"Error checking for new broadcasts: {e}")
+
+    async def cancel(self, job_id):
+        run = self.runs.get(job_id)
+        if run:
+            run.cancelled = True
+        await finish_broadcast_job(job_id, 'cancelled')
+
+    async def stop(self):
+        runs = list(self.runs.values())
+        for run in runs:
+            run.task.cancel()
+        await asyncio.gather(*(run.task for run in runs), return_exceptions=True)
+
+    async def describe(self, job_id):
+        run = self.runs.get(job_id)
+        if run:
+            status, total, sent, failed, blocked = run.status, run.total, run.sent, run.failed, run.blocked
+        else:
+            job = await get_broadcast_job(job_id)
+            if not job:
+                return f"Broadcast #{job_id} not found.", None
+            status, total, sent, failed, blocked = job[4:9]
+        text = broadcast_progress_text(job_id, status, total, sent, failed, blocked)
+        return text, broadcast_job_keyboard(job_id, status)
+
+    def _launch(self, bot, job):
+        run = BroadcastRun(job)
+        run.task = asyncio.create_task(self._run(bot, run))
+        self.runs[run.job_id] = run
+        return run
+
+    async def _run(self, bot, run):
+        reporter = asyncio.create_task(self._report_loop(bot, run))
+        try:
+            last_user_id = 0
+            while not run.cancelled:
+                chunk = await get_pending_recipients(run.job_id, last_user_id, BROADCAST_CHUNK_SIZE)
+                if not chunk:
+                    break
+                queue = deque(chunk)
+                await asyncio.gather(*(self._worker(bot, run, queue) for _ in range(BROADCAST_CONCURRENCY)))
+                last_user_id = chunk[-1]
+            run.status = 'cancelled' if run.cancelled else 'completed'
+        except asyncio.CancelledError:
+            # Shutdown: the job stays 'running' and resumes on the next start
+            self.runs.pop(run.job_id, None)
+            await self._flush(run)
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast #{run.job_id} stopped: {e}")
+            run.status = 'failed'
+        finally:
+            reporter.cancel()
+        
+        # Stays in runs until finished, so watch() never relaunches a job that is wrapping up
+        try:
+            await self._flush(run)
+            await finish_broadcast_job(run.job_id, run.status)
+        finally:
+            self.runs.pop(run.job_id, None)
+        await self._report(bot, run)
+
+    async def _worker(self, bot, run, queue):
+        while queue and not run.cancelled:
+            user_id = queue.popleft()
+            status = await self._send(bot, run, user_id)
+            run.results.append((user_id, status))
+            setattr(run, status, getattr(run, status) + 1)
+
+    async def _send(self, bot, run, user_id):
+        delay = 1
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                await bot.forward_message(
+                    chat_id=user_id,
+                    from_chat_id=run.from_chat_id,
+                    message_id=run.message_id,
+                    rate_limit_args=LANE_BULK
+                )
+                return 'sent'
+            except RetryAfter as e:
+                # The outbound scheduler already paused everyone and retried
+                logger.error(f"Gave up broadcasting to {user_id}: {e}")
+                return 'failed'
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                logger.error(f"Error broadcasting to {user_id}: {e}")
+                return 'failed'
+            except NetworkError as e:
+                logger.warning(f"Network error broadcasting to {user_id}: {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+            except Exception as e:
+                logger.error(f"Error broadcasting to {user_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+    async def _flush(self, run):
+        results, run.results = run.results, []
+        if results:
+            await record_broadcast_results(run.job_id, results)
+
+    async def _report_loop(self, bot, run):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            try:
+                await self._flush(run)
+                if worker.sharded:
+                    # Cancel and progress message may have been set by another worker
+                    job = await get_broadcast_job(run.job_id)
+                    if job and job[4] != 'running':
+                        run.cancelled = True
+                    if job and not run.progress_chat_id:
+                        run.progress_chat_id, run.progress_message_id = job[9], job[10]
+            except Exception as e:
+                logger.error(f"Error saving broadcast #{run.job_id} progress: {e}")
+            await self._report(bot, run)
+
+    async def _report(self, bot, run):
+        if not run.progress_chat_id:
+            return
+        text, reply_markup = await self.describe(run.job_id)
+        try:
+            await bot.edit_message_text(
+                text,
+                chat_id=run.progress_chat_id,
+                message_id=run.progress_message_id,
+                reply_markup=reply_markup,
+                rate_limit_args=LANE_ADMIN
+            )
+        except Exception as e:
+            if not (isinstance(e, BadRequest) and is_not_modified(e)):
+                logger.warning(f"Error updating broadcast #{run.job_id} progress: {e}")
+
+broadcasts = BroadcastManager()
+
+# Outbound Bot API scheduling
+# Every call made through the application's bot passes through one
+# scheduler that admits calls strictly by priority lane. Messages also take
+# a token from the global bucket and from their chat's bucket; other calls
+# (getChatMember, answerCallbackQuery, edits) only wait their turn. A
+# RetryAfter pauses every caller. Callers pick a lane with rate_limit_args;
+# getChatMember defaults to the membership lane, the rest to interactive.
+# In supervisor mode all workers draw on one shared OutboundBudget, so the
+# leader's broadcasts get whatever the other workers' replies leave over.
+LANE_INTERACTIVE, LANE_MEMBERSHIP, LANE_ADMIN, LANE_BULK = range(4)
+LANE_NAMES = ('interactive', 'membership', 'admin', 'bulk')
+LANE_BY_ENDPOINT = {'getChatMember': LANE_MEMBERSHIP}
+# Besides send*, calls that deliver a message and count against the limits
+MESSAGE_ENDPOINTS = ('forwardMessage', 'copyMessage')
+
+class OutboundBudget:
+    # Global token bucket plus RetryAfter pause, kept as
+    # [tokens, updated, paused_until]. Given a multiprocessing Array the
+    # state is shared by every process holding it.
+    def __init__(self, rate=OUTBOUND_RATE, values=None):
+        self.rate = rate
+        if values is None:
+            self.values = [rate, time.monotonic(), 0.0]
+            self._lock = threading.Lock()
+        else:
+            self.values = values
+            self._lock = values.get_lock()
+
+    @staticmethod
+    def shared_values(context, rate=OUTBOUND_RATE):
+        return context.Array('d', [rate, time.monotonic(), 0.0])
+
+    def take(self, cost, reserve=0):
+        # Takes cost tokens if at least reserve would remain; otherwise
+        # returns the seconds to wait before trying again
+        with self._lock:
+            tokens, updated, paused_until = self.values[:]
+            now = time.monotonic()
+            if now < paused_until:
+                return paused_until - now
+            tokens = min(self.rate, tokens + (now - updated) * self.rate)
+            self.values[1] = now
+            if tokens < cost + reserve:
+                self.values[0] = tokens
+                return (cost + reserve - tokens) / self.rate
+            self.values[0] = tokens - cost
+            return 0
+
+    def pause(self, seconds):
+        with self._lock:
+            self.values[2] = max(self.values[2], time.monotonic() + seconds)
+            # Refill starts when the pause ends
+            self.values[0], self.values[1] = 0, self.values[2]
+
+class OutboundScheduler(BaseRateLimiter[int]):
+    def __init__(self, rate=OUTBOUND_RATE, retries=OUTBOUND_RETRIES):
+        self.budget = OutboundBudget(rate)
+        self.retries = retries
+        self._waiting = []  # heap of (lane, sequence, future, tokens needed)
+        self._sequence = itertools.count()
+        self._chat_buckets = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def initialize(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for _, _, future, _ in self._waiting:
+            future.cancel()
+        self._waiting.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Group and channel ids are negative, or @usernames
+            group = isinstance(chat_id, str) or chat_id < 0
+            rate = OUTBOUND_GROUP_RATE if group else OUTBOUND_PER_CHAT_RATE
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, OUTBOUND_CHAT_BURST)
+            if len(self._chat_buckets) > OUTBOUND_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _admit(self, lane, cost):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (lane, next(self._sequence), future, cost))
+        self._wakeup.set()
+        await future
+
+    async def _dispatch(self):
+        # Hands out global tokens, always to the highest-priority waiter first
+        while True:
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            lane, _, future, cost = self._waiting[0]
+            if future.done():
+                heapq.heappop(self._waiting)
+                continue
+            wait = self.budget.take(cost, OUTBOUND_BULK_RESERVE if lane == LANE_BULK else 0)
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(self._waiting)
+            future.set_result(None)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        lane = rate_limit_args if rate_limit_args is not None else LANE_BY_ENDPOINT.get(endpoint, LANE_INTERACTIVE)
+        is_message = endpoint.startswith('send') or endpoint in MESSAGE_ENDPOINTS
+        chat_id = data.get('chat_id')
+        chat_bucket = self._chat_bucket(chat_id) if is_message and chat_id is not None else None
+        
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            if chat_bucket:
+                await chat_bucket.acquire()
+            await self._admit(lane, 1 if is_message else 0)
+            if METRICS_ENABLED:
+                metrics.observe('api', f"queue:{LANE_NAMES[lane]}", time.perf_counter() - started)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.retries:
+                    raise
+                # Everyone waits out the flood limit, not just this caller
+                seconds = retry_after_seconds(e)
+                self.budget.pause(seconds)
+                logger.warning(f"Bot API flood limit on {endpoint}, pausing all sends for {seconds}s")
+
+outbound = OutboundScheduler()
+
+# Admin notifications
+class AdminNotifier:
+    # Payment requests are queued here and sent to every admin as one digest
+    # per ADMIN_DIGEST_INTERVAL, in the background and with retries, so the
+    # user's reply never waits on admin chats
+    def __init__(self):
+        self.pending = []
+        self._bot = None
+        self._task = None
+
+    def notify(self, text):
+        self.pending.append(text)
+
+    def start(self, bot):
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(ADMIN_DIGEST_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error sending admin digest: {e}")
+
+    async def flush(self):
+        if not self.pending or self._bot is None:
+            return
+        items, self.pending = self.pending, []
+        digests = [
+            f"💳 {len(chunk)} new payment request(s):\n\n" + "\n\n".join(chunk)
+            for chunk in self.chunks(items)
+        ]
+        await asyncio.gather(*(self._send_digests(admin_id, digests) for admin_id in ADMIN_IDS))
+
+    @staticmethod
+    def chunks(items, max_items=ADMIN_DIGEST_MAX_ITEMS, max_length=MESSAGE_MAX_LENGTH - 64):
+        # Split by count and by length: a digest Telegram refuses as too long
+        # would lose every request in it (64 leaves room for the header)
+        chunk, length = [], 0
+        for item in items:
+            if chunk and (len(chunk) == max_items or length + len(item) > max_length):
+                yield chunk
+                chunk, length = [], 0
+            chunk.append(item)
+            length += len(item) + 2
+        if chunk:
+            yield chunk
+
+    async def _send_digests(self, admin_id, digests):
+        # One admin's digests go out in order; different admins in parallel
+        for text in digests:
+            await self._send(admin_id, text)
+
+    async def _send(self, admin_id, text):
+        delay = 1
+        for attempt in range(ADMIN_NOTIFY_RETRIES + 1):
+            try:
+                await self._bot.send_message(admin_id, text, parse_mode=ParseMode.HTML, rate_limit_args=LANE_ADMIN)
+                return True
+            except (RetryAfter, Forbidden, BadRequest) as e:
+                # RetryAfter has already been waited out and retried by the outbound scheduler
+                logger.error(f"Error notifying admin {admin_id}: {e}")
+                return False
+            except NetworkError as e:
+                logger.warning(f"Network error notifying admin {admin_id}: {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+            except Exception as e:
+                logger.error(f"Error notifying admin {admin_id}: {e}")
+                return False
+        logger.error(f"Gave up notifying admin {admin_id} after {ADMIN_NOTIFY_RETRIES} retries")
+        return False
+
+admin_notifier = AdminNotifier()
+
+# Image generation function (for demo purposes)
+class SourceImage:
+    def __init__(self, data, validator, etag, last_modified):
+        self.data = data
+        self.validator = validator
+        self.etag = etag
+        self.last_modified = last_modified
+        self.image = None  # Decoded and downsized lazily on a render thread
+
+def source_validator(headers, data=None):
+    # ETag or Last-Modified identify a version of the source image; without
+    # them the content hash does
+    validator = headers.get('ETag') or headers.get('Last-Modified')
+    if validator is None and data is not None:
+        validator = hashlib.sha256(data).hexdigest()
+    return validator
+
+class ImageSourceCache:
+    # One pooled keep-alive session; source images are kept in memory and
+    # refreshed with conditional GETs, so an unchanged image costs a 304
+    def __init__(self):
+        self.session = None
+        self.sources = {}
+
+    async def open(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+        )
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def fetch(self, image_url, revalidate=False):
+        # Returns a SourceImage or None; cached sources are only re-requested when revalidating
+        cached = self.sources.get(image_url)
+        if cached and not revalidate:
+            return cached
+        if self.session is None:
+            await self.open()
+        
+        headers = {}
+        if cached and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        
+        async with self.session.get(image_url, headers=headers) as response:
+            if response.status == 304 and cached:
+                return cached
+            if response.status != 200:
+                return None
+            image_data = await response.read()
+            source = SourceImage(
+                image_data,
+                source_validator(response.headers, image_data),
+                response.headers.get('ETag'),
+                response.headers.get('Last-Modified')
+            )
+            self.sources[image_url] = source
+            return source
+
+image_sources = ImageSourceCache()
+
+@functools.lru_cache(maxsize=16)
+def load_font(font_path, font_size):
+    try:
+        return ImageFont.truetype(font_path, font_size)
+    except:
+        return ImageFont.load_default()
+
+def prepare_base_image(data, max_side=PHOTO_MAX_SIDE):
+    # Decoded once per source version, downsized to what Telegram displays
+    # and flattened to RGB, so renders never touch the full-size original.
+    # JPEG has no alpha, so transparency is composited onto PHOTO_BACKGROUND
+    # instead of being dropped (which leaves black or garbage pixels).
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if image.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in image.info:
+        image = image.convert('RGBA')
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    if image.mode == 'RGBA':
+        background = Image.new('RGB', image.size, PHOTO_BACKGROUND)
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    return image
+
+def encode_photo(image, fmt=PHOTO_FORMAT, budget=PHOTO_BYTE_BUDGET, qualities=PHOTO_QUALITIES):
+    # Highest quality that fits the byte budget, else the lowest one tried
+    for quality in qualities:
+        output = io.BytesIO()
+        if fmt == 'WEBP':
+            image.save(output, format='WEBP', quality=quality, method=4)
+        else:
+            image.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+        if output.tell() <= budget:
+            break
+    return output.getvalue()
+
+def render_text_on_image(source, text, font_path=IMAGE_FONT_PATH, font_size=IMAGE_FONT_SIZE):
+    # Runs on a render thread; the prepared base image is shared, so draw on a copy
+    if source.image is None:
+        source.image = prepare_base_image(source.data)
+    image = source.image.copy()
+    
+    # Add text to image
+    draw = ImageDraw.Draw(image)
+    
+    # Position the text
+    text_position = (50, image.height - 100)
+    draw.text(text_position, text, fill=(255, 255, 255), font=load_font(font_path, font_size))
+    
+    return encode_photo(image)
+
+class RenderQueueFull(Exception):
+    pass
+
+class ImageRenderer:
+    # PIL work runs on a small thread pool; at most RENDER_QUEUE_SIZE renders
+    # may be queued or running; past that callers get RenderQueueFull
+    def __init__(self, workers=RENDER_WORKERS, queue_size=RENDER_QUEUE_SIZE):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='render')
+        self.queue_size = queue_size
+        self.pending = 0
+
+    async def render(self, image_url, text):
+        # Returns (rendered_bytes, validator) or None
+        if self.pending >= self.queue_size:
+            raise RenderQueueFull(f"{self.pending} renders already queued")
+        self.pending += 1
+        try:
+            source = await image_sources.fetch(image_url)
+            if source is None:
+                return None
+            loop = asyncio.get_running_loop()
+            rendered = await loop.run_in_executor(self._executor, render_text_on_image, source, text)
+            return rendered, source.validator
+        finally:
+            self.pending -= 1
+
+    async def call(self, fn, *args):
+        # Other PIL work (admin charts) shares the render threads and the queue cap
+        if self.pending >= self.queue_size:
+            raise RenderQueueFull(f"{self.pending} renders already queued")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+renderer = ImageRenderer()
+
+async def probe_source_validator(image_url):
+    source = await image_sources.fetch(image_url, revalidate=True)
+    return source.validator if source else None
+
+# Rendered image cache
+# Rendered images are cached by (image URL, overlay text, font and encoding
+# params), so changing PHOTO_* settings renders afresh. After the first
+# upload Telegram's file_id is kept, so later sends skip the download, the
+# render and the upload entirely.
+def image_cache_key(image_url, text, font_path=IMAGE_FONT_PATH, font_size=IMAGE_FONT_SIZE):
+    raw = json.dumps([image_url, text, font_path, font_size, PHOTO_FORMAT, PHOTO_MAX_SIDE, PHOTO_BYTE_BUDGET, PHOTO_BACKGROUND])
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+class CachedImage:
+    def __init__(self, key, image_url, text, validator, rendered, file_id):
+        self.key = key
+        self.image_url = image_url
+        self.text = text
+        self.validator = validator
+        self.rendered = rendered
+        self.file_id = file_id
+        self.checked_at = time.monotonic()
+
+class ImageCache:
+    def __init__(self):
+        self.entries = {}
+        self._locks = {}
+        self._revalidating = set()
+        self._tasks = set()  # The loop keeps only weak references to tasks
+
+    async def get(self, image_url, text):
+        key = image_cache_key(image_url, text)
+        entry = self.entries.get(key)
+        if entry is None:
+            row = await get_cached_image(key)
+            if row:
+                entry = self.entries[key] = CachedImage(key, *row)
+        if (entry and key not in self._revalidating
+                and time.monotonic() - entry.checked_at > IMAGE_CACHE_REVALIDATE_SECONDS):
+            self._revalidating.add(key)
+            task = asyncio.create_task(self._revalidate(entry))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return key, entry
+
+    async def render(self, key, image_url, text):
+        result = await renderer.render(image_url, text)
+        if result is None:
+            return None
+        rendered, validator = result
+        entry = self.entries[key] = CachedImage(key, image_url, text, validator, rendered, None)
+        await save_cached_image(key, image_url, text, validator, rendered)
+        return entry
+
+    async def send_photo(self, bot, chat_id, image_url, text, caption, reply_markup=None, render=True):
+        # render=False never starts a render; without a cached one the plain image is sent
+        key, entry = await self.get(image_url, text)
+        if entry and entry.file_id:
+            try:
+                return await bot.send_photo(chat_id=chat_id, photo=entry.file_id, caption=caption, reply_markup=reply_markup)
+            except BadRequest as e:
+                if 'file' not in str(e).lower():
+                    raise
+                logger.warning(f"Cached photo for {image_url} rejected, uploading again: {e}")
+                entry.file_id = None
+                await set_cached_image_file_id(key, None)
+        
+        # Only one sender renders and uploads a given image; the rest wait for
+        # its file_id, then send outside the lock so they go out in parallel
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            entry = self.entries.get(key)
+            file_id = entry.file_id if entry else None
+            if file_id is None:
+                if (entry is None or entry.rendered is None) and not render:
+                    entry = None
+                elif entry is None or entry.rendered is None:
+                    try:
+                        entry = await self.render(key, image_url, text)
+                    except RenderQueueFull as e:
+                        logger.warning(f"Skipping render of {image_url}: {e}")
+                        entry = None
+                    except Exception as e:
+                        logger.error(f"Error generating image: {e}")
+                        entry = None
+                
+                if entry is not None:
+                    message = await bot.send_photo(chat_id=chat_id, photo=entry.rendered, caption=caption, reply_markup=reply_markup)
+                    entry.file_id = message.photo[-1].file_id
+                    await set_cached_image_file_id(key, entry.file_id)
+                    return message
+        
+        # Without a render, fall back to letting Telegram fetch the plain image
+        return await bot.send_photo(chat_id=chat_id, photo=file_id or image_url, caption=caption, reply_markup=reply_markup)
+
+    async def invalidate(self, key):
+        self.entries.pop(key, None)
+        await delete_cached_image(key)
+
+    async def clear(self):
+        self.entries.clear()
+        await clear_cached_images()
+
+    async def _revalidate(self, entry):
+        try:
+            validator = await probe_source_validator(entry.image_url)
+            if validator is not None and validator != entry.validator:
+                logger.info(f"Source image {entry.image_url} changed, dropping cached render")
+                await self.invalidate(entry.key)
+            else:
+                entry.checked_at = time.monotonic()
+        except Exception as e:
+            logger.warning(f"Error revalidating {entry.image_url}: {e}")
+        finally:
+            self._revalidating.discard(entry.key)
+
+image_cache = ImageCache()
+
+# Funnel trend chart
+FUNNEL_EVENT_STYLES = {
+    'joins': ("Joins", (52, 101, 164)),
+    'verified': ("Verified", (78, 154, 6)),
+    'codes': ("Codes", (245, 121, 0)),
+    'payments': ("Payments", (204, 0, 0)),
+}
+
+def funnel_chart_days(days=FUNNEL_CHART_DAYS):
+    today = datetime.now(timezone.utc).date()
+    return [(today - timedelta(days=offset)).isoformat() for offset in range(days - 1, -1, -1)]
+
+def render_funnel_chart(days, rows, width=900, height=480):
+    # Runs on a render thread; one line per funnel event over the given days
+    series = {event: [0] * len(days) for event in FUNNEL_EVENTS}
+    index = {day: i for i, day in enumerate(days)}
+    for day, event, count in rows:
+        if event in series and day in index:
+            series[event][index[day]] = count
+    peak = max([1] + [max(values) for values in series.values()])
+    
+    image = Image.new('RGB', (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    font = load_font(IMAGE_FONT_PATH, 14)
+    left, top, right, bottom = 60, 50, width - 20, height - 40
+    
+    draw.text((left, 15), f"Funnel events per day (UTC), last {len(days)} days", fill=(0, 0, 0), font=font)
+    for step in range(5):
+        y = bottom - (bottom - top) * step / 4
+        draw.line([(left, y), (right, y)], fill=(225, 225, 225))
+        draw.text((5, y - 7), f"{peak * step / 4:g}", fill=(90, 90, 90), font=font)
+    draw.line([(left, top), (left, bottom), (right, bottom)], fill=(0, 0, 0))
+    
+    x_step = (right - left) / max(1, len(days) - 1)
+    label_every = max(1, len(days) // 7)
+    for i, day in enumerate(days):
+        if i % label_every == 0 or i == len(days) - 1:
+            draw.text((left + i * x_step - 18, bottom + 8), day[5:], fill=(90, 90, 90), font=font)
+    
+    for n, event in enumerate(FUNNEL_EVENTS):
+        label, color = FUNNEL_EVENT_STYLES[event]
+        points = [(left + i * x_step, bottom - (bottom - top) * value / peak) for i, value in enumerate(series[event])]
+        if len(points) > 1:
+            draw.line(points, fill=color, width=3)
+        for x, y in points:
+            draw.ellipse([(x - 3, y - 3), (x + 3, y + 3)], fill=color)
+        legend_x = right - 110 * (len(FUNNEL_EVENTS) - n)
+        draw.rectangle([(legend_x, 18), (legend_x + 12, 30)], fill=color)
+        draw.text((legend_x + 18, 15), label, fill=(0, 0, 0), font=font)
+    
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+def funnel_chart_caption(rows):
+    totals = dict.fromkeys(FUNNEL_EVENTS, 0)
+    for _, event, count in rows:
+        if event in totals:
+            totals[event] += count
+    steps = " → ".join(f"{FUNNEL_EVENT_STYLES[event][0]} {totals[event]}" for event in FUNNEL_EVENTS)
+    return f"📈 Last {FUNNEL_CHART_DAYS} days: {steps}"
+
+class FunnelChart:
+    # The uploaded chart's file_id is kept together with a digest of the
+    # rollup rows it was drawn from. Until an event changes a rollup (or the
+    # day rolls over), repeat views resend the file_id without rendering.
+    def __init__(self, days=FUNNEL_CHART_DAYS):
+        self.days = days
+        self.digest = None
+        self.file_id = None
+        self._lock = asyncio.Lock()
+
+    async def send(self, bot, chat_id, reply_markup=None):
+        days = funnel_chart_days(self.days)
+        rows = await get_funnel_rollups(days[0])
+        digest = hashlib.sha1(json.dumps([days, rows]).encode()).hexdigest()
+        caption = funnel_chart_caption(rows)
+        
+        async with self._lock:
+            if digest == self.digest and self.file_id:
+                try:
+                    return await bot.send_photo(chat_id=chat_id, photo=self.file_id, caption=caption, reply_markup=reply_markup)
+                except BadRequest as e:
+                    if 'file' not in str(e).lower():
+                        raise
+                    self.file_id = None
+            
+            chart = await renderer.call(render_funnel_chart, days, rows)
+            message = await bot.send_photo(chat_id=chat_id, photo=chart, caption=caption, reply_markup=reply_markup)
+            self.digest, self.file_id = digest, message.photo[-1].file_id
+            return message
+
+funnel_chart = FunnelChart()
+
+# Anti-flood limiting
+class FloodLimiter:
+    # Per-user token buckets for each guarded handler, plus a process-wide
+    # view of load taken from the update processor. Excess taps are dropped
+    # before they reach the database, the renderer or getChatMember.
+    def __init__(self, limits=FLOOD_LIMITS, maxsize=FLOOD_TRACKED_USERS):
+        self.limits = limits
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    @staticmethod
+    def pending(context):
+        return getattr(context.application.update_processor, 'pending', 0)
+
+    def busy(self, context):
+        # Saturated: handlers should reuse cached images and skip new renders
+        return (self.pending(context) >= FLOOD_BUSY_PENDING
+                or renderer.pending >= renderer.queue_size // 2)
+
+    def admit(self, name, user_id, context):
+        if self.pending(context) >= FLOOD_SHED_PENDING:
+            return 'shed'
+        key = (name, user_id)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limits[name]
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return None if bucket.try_acquire() else 'throttled'
+
+flood = FloodLimiter()
+
+def flood_guarded(name):
+    # Decorator for user-facing handlers; admins are never limited
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(update, context):
+            user = update.effective_user
+            if user and user.id not in ADMIN_IDS:
+                refused = flood.admit(name, user.id, context)
+                if refused:
+                    if METRICS_ENABLED:
+                        metrics.inc('handler', refused, fn.__name__)
+                    if update.callback_query:
+                        # Stops the button spinner without doing any of the work
+                        await update.callback_query.answer("Too many requests, please wait a moment.")
+                    return
+            return await fn(update, context)
+        return wrapper
+    return decorator
+
+# Persistence and warm start
+class SqlitePersistence(BasePersistence):
+    # Keeps context.user_data (the admin input flags) in bot.db. Only
+    # user_data is stored; bot/chat data, callback data and conversations
+    # are not used by this bot.
+    def __init__(self, update_interval=PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._saved = {}  # user_id -> last JSON written, to skip unchanged rows
+
+    async def get_user_data(self):
+        await init_db()
+        user_data = await get_all_user_data()
+        self._saved = {user_id: json.dumps(data, sort_keys=True) for user_id, data in user_data.items()}
+        return user_data
+
+    async def update_user_data(self, user_id, data):
+        encoded = json.dumps(data, sort_keys=True, default=str)
+        if self._saved.get(user_id, '{}') == encoded:
+            return
+        await save_user_data([(user_id, encoded)])
+        self._saved[user_id] = encoded
+
+    async def drop_user_data(self, user_id):
+        self._saved.pop(user_id, None)
+        await delete_user_data(user_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def flush(self):
+        pass  # Every update is written straight through
+
+class WarmSnapshot:
+    # In-memory state that is expensive to rebuild but not kept in tables of
+    # its own: the registered user ids that let /start skip its write, and the
+    # admin chart's file_id. Uploaded image file_ids, channels and membership
+    # results are already in bot.db. The snapshot is restored in the
+    # background after startup and saved every PERSISTENCE_INTERVAL and on
+    # shutdown, but only the parts that changed since the last save.
+    def __init__(self):
+        self._task = None
+        self.saved_version = None  # registrations.version at the last save or load
+        self.saved_chart = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.save()
 
-# Channel management functions
-def get_channels():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM channels ORDER BY sequence")
-    channels = cursor.fetchall()
-    conn.close()
-    return channels
+    async def _run(self):
+        try:
+            await self.load()
+        except Exception as e:
+            logger.error(f"Error loading warm-start snapshot: {e}")
+        while True:
+            await asyncio.sleep(PERSISTENCE_INTERVAL)
+            try:
+                await self.save()
+            except Exception as e:
+                logger.error(f"Error saving warm-start snapshot: {e}")
 
-def add_channel(channel_id, username, title, invite_link, is_private):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Get the next sequence number
-    cursor.execute("SELECT MAX(sequence) FROM channels")
-    max_seq = cursor.fetchone()[0]
-    sequence = max_seq + 1 if max_seq is not None else 1
-    
-    cursor.execute(
-        "INSERT INTO channels (channel_id, username, title, invite_link, is_private, sequence) VALUES (?, ?, ?, ?, ?, ?)",
-        (channel_id, username, title, invite_link, is_private, sequence)
-    )
-    conn.commit()
-    conn.close()
+    async def load(self):
+        started = time.perf_counter()
+        known = await get_warm_state(f"known_users:{worker.index}")
+        if known:
+            user_ids = array.array('q')
+            user_ids.frombytes(known)
+            # Restored ids go behind any seen since the restart, in their saved order
+            for user_id in reversed(user_ids[-KNOWN_USERS_CACHE_SIZE:]):
+                if user_id not in registrations.known:
+                    registrations.known[user_id] = True
+                    registrations.known.move_to_end(user_id, last=False)
+            while len(registrations.known) > KNOWN_USERS_CACHE_SIZE:
+                registrations.known.popitem(last=False)
+            if not registrations.version:
+                self.saved_version = 0  # Nothing new since the saved copy
+        chart = await get_warm_state('funnel_chart')
+        if chart and funnel_chart.file_id is None:
+            funnel_chart.digest, funnel_chart.file_id = json.loads(chart)
+            self.saved_chart = funnel_chart.file_id
+        logger.info(f"Warm-start snapshot restored in {time.perf_counter() - started:.2f}s "
+                    f"({len(registrations.known)} known users)")
 
-def delete_channel(channel_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM channels WHERE channel_id = ?", (channel_id,))
-    conn.commit()
-    conn.close()
+    async def save(self):
+        # The known-user blob is up to KNOWN_USERS_CACHE_SIZE * 8 bytes, so an
+        # unchanged one is not rewritten (recency order alone does not count)
+        version, chart = registrations.version, funnel_chart.file_id
+        items = []
+        if version != self.saved_version:
+            user_ids = array.array('q', registrations.known)
+            items.append((f"known_users:{worker.index}", user_ids.tobytes()))
+        if chart and chart != self.saved_chart:
+            items.append(('funnel_chart', json.dumps([funnel_chart.digest, chart])))
+        if not items:
+            return
+        await save_warm_state(items)
+        self.saved_version, self.saved_chart = version, chart
 
-def update_channel_sequence(channel_id, new_sequence):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE channels SET sequence = ? WHERE channel_id = ?", (new_sequence, channel_id))
-    conn.commit()
-    conn.close()
+warm_snapshot = WarmSnapshot()
 
-# User management functions
-def add_user(user_id, username, first_name, last_name):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name) VALUES (?, ?, ?, ?)",
-        (user_id, username, first_name, last_name)
-    )
-    conn.commit()
-    conn.close()
-
-def update_user_verification(user_id, verified):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET verified = ? WHERE user_id = ?", (verified, user_id))
-    conn.commit()
-    conn.close()
-
-def update_user_code_sent(user_id, code_sent):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET code_sent = ? WHERE user_id = ?", (code_sent, user_id))
-    conn.commit()
-    conn.close()
-
-def update_user_upi_sent(user_id, upi_sent):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET upi_sent = ? WHERE user_id = ?", (upi_sent, user_id))
-    conn.commit()
-    conn.close()
-
-def get_all_users():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users")
-    users = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return users
+# On-demand profiling
+def metrics_totals():
+    # (count, sum) per histogram; taken on the event loop, which adds new keys
+    return {key: (histogram.count, histogram.sum) for key, histogram in list(metrics.histograms.items())}
 
-# Payment functions
-def add_payment(user_id, upi_id, amount):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO payments (user_id, upi_id, amount, status) VALUES (?, ?, ?, ?)",
-        (user_id, upi_id, amount, 'pending')
-    )
-    conn.commit()
-    conn.close()
+def build_profile_report(profile, before, after, metrics_before, metrics_after, elapsed, limit=PROFILE_REPORT_LINES):
+    # Runs off the event loop, so it only reads copies: the profile and
+    # snapshots are finished, and the metrics totals were copied on the loop
+    sections = [f"Profile of {elapsed:.1f}s on worker {worker.index} (pid {os.getpid()})"]
+    
+    for sort_key, title in (('tottime', "own time"), ('cumulative', "cumulative time")):
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).strip_dirs().sort_stats(sort_key).print_stats(limit)
+        sections.append(f"== Hottest functions by {title} (event loop thread) ==\n{output.getvalue().strip()}")
+    
+    rows = []
+    for (kind, name), (count_after, total_after) in metrics_after.items():
+        count, total = metrics_before.get((kind, name), (0, 0.0))
+        calls = count_after - count
+        if calls:
+            rows.append((total_after - total, kind, name, calls))
+    rows.sort(reverse=True)
+    lines = [f"{kind:<8}{name:<36}{calls:>8} calls {spent * 1000:>10.1f}ms total {spent * 1000 / calls:>8.1f}ms mean"
+             for spent, kind, name, calls in rows[:limit]]
+    sections.append("== Slowest handlers, DB and Bot API calls in the window ==\n"
+                    + ("\n".join(lines) if lines else "(no timed calls; METRICS_ENABLED may be off)"))
+    
+    ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, pstats.__file__))
+    before, after = before.filter_traces(ignore), after.filter_traces(ignore)
+    growth = [str(stat) for stat in after.compare_to(before, 'lineno')[:limit]]
+    sections.append("== Allocation growth by site ==\n" + "\n".join(growth))
+    largest = [str(stat) for stat in after.statistics('lineno')[:limit]]
+    sections.append("== Largest allocations still live, by site (traced since the window began unless tracemalloc was already on) ==\n" + "\n".join(largest))
+    return "\n\n".join(sections) + "\n"
 
-# Image generation function (for demo purposes)
-async def generate_image_with_text(image_url, text):
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(image_url) as response:
-                if response.status == 200:
-                    image_data = await response.read()
-                    image = Image.open(io.BytesIO(image_data))
-                    
-                    # Add text to image
-                    draw = ImageDraw.Draw(image)
-                    # You might need to adjust font path based on your system
-                    try:
-                        font = ImageFont.truetype("arial.ttf", 30)
-                    except:
-                        font = ImageFont.load_default()
-                    
-                    # Position the text
-                    text_position = (50, image.height - 100)
-                    draw.text(text_position, text, fill=(255, 255, 255), font=font)
-                    
-                    # Save to bytes
-                    img_byte_arr = io.BytesIO()
-                    image.save(img_byte_arr, format='PNG')
-                    img_byte_arr.seek(0)
-                    
-                    return img_byte_arr
-    except Exception as e:
-        logger.error(f"Error generating image: {e}")
-        return None
+class Profiler:
+    # One time-boxed capture at a time: cProfile on the event loop thread
+    # (handlers, routing, JSON, scheduling), a tracemalloc diff, and how the
+    # metrics histograms grew over the window. The report is built off the
+    # event loop and sent to the admin as a text file.
+    def __init__(self):
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, bot, chat_id, seconds):
+        self.task = asyncio.create_task(self._run(bot, chat_id, seconds))
+
+    async def stop(self):
+        if self.running:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def _run(self, bot, chat_id, seconds):
+        loop = asyncio.get_running_loop()
+        metrics_before = metrics_totals()
+        owns_tracing = not tracemalloc.is_tracing()
+        profile = cProfile.Profile()
+        try:
+            if owns_tracing:
+                # Nothing is traced yet, so the window starts from an empty
+                # snapshot and the final one only holds the window's allocations
+                tracemalloc.start(PROFILE_TRACE_FRAMES)
+                before = tracemalloc.Snapshot((), PROFILE_TRACE_FRAMES)
+            else:
+                before = await loop.run_in_executor(None, tracemalloc.take_snapshot)
+            started = time.perf_counter()
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+            elapsed = time.perf_counter() - started
+            metrics_after = metrics_totals()
+            after = await loop.run_in_executor(None, tracemalloc.take_snapshot)
+        finally:
+            if owns_tracing:
+                tracemalloc.stop()
+        
+        try:
+            report = await loop.run_in_executor(
+                None, build_profile_report, profile, before, after, metrics_before, metrics_after, elapsed
+            )
+            await bot.send_document(
+                chat_id=chat_id,
+                document=report.encode(),
+                filename=f"profile-{time.strftime('%Y%m%d-%H%M%S')}.txt",
+                caption=f"🔬 Profile of {elapsed:.0f}s"
+            )
+        except Exception as e:
+            logger.error(f"Error sending profile report: {e}")
+
+profiler = Profiler()
 
 # Command handlers
+@timed('handler')
+@flood_guarded('start')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    add_user(user.id, user.username, user.first_name, user.last_name)
+    registrations.add(user.id, user.username, user.first_name, user.last_name)
     
     # Send first image with channel list
-    channels = get_channels()
-    keyboard = []
-    
-    for channel in channels:
-        channel_id, username, title, invite_link, is_private, required, sequence = channel
-        keyboard.append([InlineKeyboardButton(title, url=invite_link)])
-    
-    keyboard.append([InlineKeyboardButton("✅ I've Joined All", callback_data="verify_join")])
+    reply_markup = channel_registry.join_keyboard
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    # Generate or fetch the image
-    image_url = f"{DOMAIN}/images/welcome.jpg"
+    # Send the cached render, generating it on first use (falls back to the plain image URL)
+    image_url, image_text = WELCOME_IMAGE
     caption = "Welcome! Please join all the channels below to continue:"
     
-    # Try to generate image with text, fallback to sending URL if fails
-    image_bytes = await generate_image_with_text(image_url, "Welcome!")
-    
-    if image_bytes:
-        await update.message.reply_photo(
-            photo=image_bytes,
-            caption=caption,
-            reply_markup=reply_markup
-        )
-    else:
-        await update.message.reply_photo(
-            photo=image_url,
-            caption=caption,
-            reply_markup=reply_markup
-        )
+    await image_cache.send_photo(
+        context.bot,
+        update.effective_chat.id,
+        image_url,
+        image_text,
+        caption,
+        reply_markup=reply_markup,
+        render=not flood.busy(context)
+    )
 
+@timed('handler')
+@flood_guarded('verify_join')
 async def verify_join_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -253,19 +2677,7 @@ async def verify_join_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     channels = get_channels()
     
     # Check if user is member of all channels
-    not_joined = []
-    for channel in channels:
-        channel_id, username, title, invite_link, is_private, required, sequence = channel
-        
-        try:
-            member = await context.bot.get_chat_member(channel_id, user_id)
-            if member.status in ['left', 'kicked']:
-                not_joined.append(title)
-        except BadRequest:
-            not_joined.append(title)
-        except Exception as e:
-            logger.error(f"Error checking membership: {e}")
-            not_joined.append(title)
+    not_joined, unchecked = await check_memberships(context.bot, user_id, channels)
     
     if not_joined:
         await query.edit_message_caption(
@@ -273,106 +2685,261 @@ async def verify_join_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return
     
-    # User has joined all channels
-    update_user_verification(user_id, 1)
+    if unchecked:
+        await query.edit_message_caption(
+            caption=f"Couldn't check these channels right now: {', '.join(unchecked)}. Please try again in a few seconds."
+        )
+        return
+    
+    # User has joined all channels; funnel.get also brings back an archived user
+    await registrations.ensure_flushed(user_id)
+    await funnel.get(user_id)
+    await update_user_verification(user_id, 1)
     
     # Send second image with verification code
-    image_url = f"{DOMAIN}/images/verification.jpg"
+    image_url, image_text = VERIFICATION_IMAGE
     caption = f"Thank you for joining! Your verification code is: {VERIFICATION_CODE}\n\nPlease send this code to continue."
     
-    # Generate or fetch the image
-    image_bytes = await generate_image_with_text(image_url, f"Code: {VERIFICATION_CODE}")
-    
-    if image_bytes:
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=image_bytes,
-            caption=caption
-        )
-    else:
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=image_url,
-            caption=caption
-        )
+    await image_cache.send_photo(
+        context.bot, query.message.chat_id, image_url, image_text, caption,
+        render=not flood.busy(context)
+    )
     
-    update_user_code_sent(user_id, 1)
+    await funnel.advance(user_id, 'joined')
 
+@timed('handler')
+@flood_guarded('code')
 async def handle_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_code = update.message.text.strip()
     
-    # Check if user has been sent the code
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT code_sent FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result or not result[0]:
-        await update.message.reply_text("Please start the verification process with /start first.")
-        return
-    
     if user_code == VERIFICATION_CODE:
         await update.message.reply_text("Code verified! Please send your UPI ID to make the payment of ₹10.")
-        update_user_upi_sent(user_id, 1)
+        await funnel.advance(user_id, 'code_verified')
     else:
         await update.message.reply_text("Invalid code. Please try again.")
 
+@timed('handler')
+@flood_guarded('upi')
 async def handle_upi(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     upi_id = update.message.text.strip()
     
-    # Check if user has been asked for UPI
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT upi_sent FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if not result or not result[0]:
-        await update.message.reply_text("Please complete the previous steps first.")
-        return
-    
-    # Validate UPI ID (basic validation)
-    if not upi_id.lower().endswith('@upi'):
+    # Validate UPI ID (basic validation); the length cap keeps admin digests and pages within Telegram's limits
+    if not upi_id.lower().endswith('@upi') or len(upi_id) > UPI_ID_MAX_LENGTH:
         await update.message.reply_text("Please enter a valid UPI ID (e.g., name@upi).")
         return
     
     # Add payment record
-    add_payment(user_id, upi_id, 10.0)
+    await add_payment(user_id, upi_id, 10.0)
+    await funnel.advance(user_id, 'awaiting_payment')
     
     # Send payment instructions
     payment_text = f"Please send ₹10 to the following UPI ID: {upi_id}\n\nAfter payment, you will be granted access."
     await update.message.reply_text(payment_text)
     
-    # Notify admins
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(
-                admin_id,
-                f"New payment request:\nUser: {update.effective_user.mention_markdown()}\nUPI: {upi_id}\nAmount: ₹10"
-            )
-        except Exception as e:
-            logger.error(f"Error notifying admin: {e}")
+    # Notify admins with the next digest
+    admin_notifier.notify(
+        f"User: {update.effective_user.mention_html()}\nUPI: {html.escape(upi_id)}\nAmount: ₹10"
+    )
+
+# Message routing
+# Text steps of the funnel, by the user's current state. Users may resend a
+# UPI ID after a payment request, as before.
+TEXT_ROUTES = {
+    'joined': handle_code,
+    'code_verified': handle_upi,
+    'awaiting_payment': handle_upi,
+}
+
+@timed('handler')
+async def route_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Admin flows waiting for input come first
+    if update.effective_user.id in ADMIN_IDS:
+        if context.user_data.get('awaiting_channel'):
+            await handle_channel_forward(update, context)
+            return
+        if context.user_data.get('awaiting_broadcast_range'):
+            await handle_broadcast_range(update, context)
+            return
+        if context.user_data.get('awaiting_broadcast'):
+            await handle_broadcast_message(update, context)
+            return
+    
+    if not update.message.text:
+        return
+    
+    state = await funnel.get(update.effective_user.id)
+    handler = TEXT_ROUTES.get(state)
+    if handler is None:
+        await update.message.reply_text("Please start the verification process with /start first.")
+        return
+    await handler(update, context)
+
+# Activity tracking
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs before every other handler; only direct interaction counts
+    if (update.message or update.callback_query) and update.effective_user:
+        archiver.touch(update.effective_user.id)
+
+@timed('handler')
+async def track_bot_blocked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # my_chat_member in a private chat: the user blocked ('kicked') or unblocked the bot
+    change = update.my_chat_member
+    if change.chat.type != 'private':
+        return
+    await set_user_blocked(change.chat.id, change.new_chat_member.status == 'kicked')
+
+# Membership tracking
+@timed('handler')
+async def track_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # chat_member updates arrive for every channel the bot administers
+    change = update.chat_member
+    if change.chat.id not in channel_registry.channel_ids:
+        return
+    member = change.new_chat_member
+    await record_memberships([(member.user.id, change.chat.id, member.status)])
 
 # Admin commands
+@timed('handler')
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Also the target of every "⬅️ Back" button, which edits the panel in place
     user_id = update.effective_user.id
+    query = update.callback_query
     
     if user_id not in ADMIN_IDS:
-        await update.message.reply_text("You are not authorized to use this command.")
+        if query:
+            await query.edit_message_text("You are not authorized to use this feature.")
+        else:
+            await update.message.reply_text("You are not authorized to use this command.")
         return
     
     keyboard = [
         [InlineKeyboardButton("Manage Channels", callback_data="admin_channels")],
         [InlineKeyboardButton("Broadcast Message", callback_data="admin_broadcast")],
+        [InlineKeyboardButton("Review Payments", callback_data="admin_payments")],
         [InlineKeyboardButton("Stats", callback_data="admin_stats")]
     ]
     
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Admin Panel:", reply_markup=reply_markup)
+    if query:
+        await query.edit_message_text("Admin Panel:", reply_markup=reply_markup)
+    else:
+        await update.message.reply_text("Admin Panel:", reply_markup=reply_markup)
+
+@timed('handler')
+async def image_cache_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+    
+    action = context.args[0] if context.args else "status"
+    
+    if action == "clear":
+        await image_cache.clear()
+        await update.message.reply_text("Image cache cleared.")
+    elif action == "warm":
+        # Uploading to the admin chat renders each image and records its file_id
+        for image_url, image_text in (WELCOME_IMAGE, VERIFICATION_IMAGE):
+            await image_cache.send_photo(
+                context.bot,
+                update.effective_chat.id,
+                image_url,
+                image_text,
+                f"Cached: {image_url}"
+            )
+        await update.message.reply_text("Image cache warmed.")
+    elif action == "status":
+        rows = await get_cached_image_summary()
+        if not rows:
+            await update.message.reply_text("Image cache is empty.")
+            return
+        lines = [
+            f"{'✅' if has_file_id else '⏳'} {image_url} \"{text}\" ({size or 0} bytes, {updated_at})"
+            for image_url, text, size, has_file_id, updated_at in rows
+        ]
+        await update.message.reply_text("🖼 Image cache:\n" + "\n".join(lines))
+    else:
+        await update.message.reply_text("Usage: /imagecache [status|warm|clear]")
+
+@timed('handler')
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+    
+    if not METRICS_ENABLED:
+        await update.message.reply_text("Metrics are disabled (METRICS_ENABLED = False).")
+        return
+    
+    await update.message.reply_text(metrics.summary())
+
+@timed('handler')
+async def archive_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+    
+    action = context.args[0] if context.args else "status"
+    
+    if action == "run":
+        # Any worker may run a pass: batches are serialized by the write lock
+        # and other workers learn of them through archive_version
+        moved = await archiver.archive()
+        await update.message.reply_text(f"🗄 Archived {moved} users.")
+    elif action == "restore" and len(context.args) == 2 and context.args[1].lstrip('-').isdigit():
+        user_id = int(context.args[1])
+        state = await restore_archived_user(user_id)
+        if state is None:
+            await update.message.reply_text(f"User {user_id} is not archived.")
+            return
+        funnel.forget([user_id])
+        await update.message.reply_text(f"♻️ Restored user {user_id} ({state}).")
+    elif action == "status":
+        total_users, archived_users = await get_counters(['users', 'archived_users'])
+        await update.message.reply_text(
+            f"🗄 {archived_users} of {total_users} users archived "
+            f"(blocked, or idle for {ARCHIVE_INACTIVE_DAYS}+ days). "
+            f"Archived users are restored on their next /start or message."
+        )
+    else:
+        await update.message.reply_text("Usage: /archive [status|run|restore <user_id>]")
+
+@timed('handler')
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+    
+    try:
+        seconds = int(context.args[0]) if context.args else PROFILE_DEFAULT_SECONDS
+        target = int(context.args[1]) if len(context.args) > 1 else worker.index
+    except ValueError:
+        target = -1
+    if not 0 <= target < worker.count:
+        await update.message.reply_text(
+            f"Usage: /profile [seconds, at most {PROFILE_MAX_SECONDS}] [worker, 0-{worker.count - 1}]"
+        )
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    
+    if target != worker.index:
+        # Admin updates always reach the same shard; the request goes through the database
+        await request_profile(target, update.effective_chat.id, seconds)
+        await update.message.reply_text(
+            f"🔬 Worker {target} will profile for {seconds}s once it sees the request "
+            f"(within {SHARED_STATE_INTERVAL}s); the report will follow as a file."
+        )
+        return
+    
+    if profiler.running:
+        await update.message.reply_text("A profile is already being captured.")
+        return
+    
+    profiler.start(context.bot, update.effective_chat.id, seconds)
+    await update.message.reply_text(f"🔬 Profiling worker {worker.index} for {seconds}s; the report will follow as a file.")
 
+@timed('handler')
 async def admin_channels_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -381,27 +2948,14 @@ async def admin_channels_callback(update: Update, context: ContextTypes.DEFAULT_
         await query.edit_message_text("You are not authorized to use this feature.")
         return
     
-    channels = get_channels()
-    keyboard = []
-    
-    for channel in channels:
-        channel_id, username, title, invite_link, is_private, required, sequence = channel
-        keyboard.append([
-            InlineKeyboardButton(f"❌ {title}", callback_data=f"delete_channel_{channel_id}"),
-            InlineKeyboardButton("⬆️", callback_data=f"move_up_{channel_id}"),
-            InlineKeyboardButton("⬇️", callback_data=f"move_down_{channel_id}")
-        ])
-    
-    keyboard.append([InlineKeyboardButton("➕ Add Channel", callback_data="add_channel")])
-    keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="admin_back")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = channel_registry.admin_keyboard
     
     await query.edit_message_text(
         "Channel Management:\nClick ❌ to delete a channel\nUse ⬆️ ⬇️ to change order",
         reply_markup=reply_markup
     )
 
+@timed('handler')
 async def add_channel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -416,6 +2970,7 @@ async def add_channel_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     # Set state to wait for channel info
     context.user_data['awaiting_channel'] = True
 
+@timed('handler')
 async def handle_channel_forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS or not context.user_data.get('awaiting_channel'):
         return
@@ -449,7 +3004,7 @@ async def handle_channel_forward(update: Update, context: ContextTypes.DEFAULT_T
             invite_link = f"https://t.me/{username}" if username else "No invite link available"
         
         # Add channel to database
-        add_channel(channel_id, username, title, invite_link, 0 if username else 1)
+        await add_channel(channel_id, username, title, invite_link, 0 if username else 1)
         
         await update.message.reply_text(f"Channel {title} added successfully!")
         context.user_data['awaiting_channel'] = False
@@ -459,6 +3014,7 @@ async def handle_channel_forward(update: Update, context: ContextTypes.DEFAULT_T
     else:
         await update.message.reply_text("Please forward a message from the channel you want to add.")
 
+@timed('handler')
 async def admin_broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -467,75 +3023,223 @@ async def admin_broadcast_callback(update: Update, context: ContextTypes.DEFAULT
         await query.edit_message_text("You are not authorized to use this feature.")
         return
     
-    await query.edit_message_text(
-        "Send the message you want to broadcast. You can include text, photos, or documents."
+    # Pick the audience first; broadcasts that are still running get controls
+    keyboard = [
+        [InlineKeyboardButton(label, callback_data=f"bcast_seg_{key}")]
+        for key, (label, _) in BROADCAST_SEGMENTS.items()
+    ]
+    keyboard.append([InlineKeyboardButton("📅 Joined between dates…", callback_data="bcast_seg_range")])
+    keyboard.extend(
+        [InlineKeyboardButton(f"📣 Broadcast #{job[0]}", callback_data=f"bcast_status_{job[0]}")]
+        for job in await get_running_broadcast_jobs()
     )
+    keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="admin_back")])
+    
+    await query.edit_message_text("Who should receive the broadcast?", reply_markup=InlineKeyboardMarkup(keyboard))
+    context.user_data['awaiting_broadcast'] = False
+    context.user_data['awaiting_broadcast_range'] = False
+
+async def choose_broadcast_segment(context, segment):
+    # Remembers the audience and returns the prompt for the broadcast message
+    label, _, _ = segment_query(segment)
+    audience = await count_segment_users(segment)
+    context.user_data['broadcast_segment'] = segment
     context.user_data['awaiting_broadcast'] = True
+    return (f"Audience: {label} ({audience} users).\n\n"
+            "Send the message you want to broadcast. You can include text, photos, or documents.")
 
-async def handle_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id not in ADMIN_IDS or not context.user_data.get('awaiting_broadcast'):
-        return
+@timed('handler')
+async def broadcast_segment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-    users = get_all_users()
-    success = 0
-    failed = 0
+    if query.from_user.id not in ADMIN_IDS:
+        await query.edit_message_text("You are not authorized to use this feature.")
+        return
     
-    # Send to all users
-    for user_id in users:
-        try:
-            # Forward the message
-            await update.message.forward(user_id)
-            success += 1
-        except Exception as e:
-            logger.error(f"Error broadcasting to {user_id}: {e}")
-            failed += 1
-        
-        # Small delay to avoid rate limiting
-        await asyncio.sleep(0.1)
+    segment = query.data[len("bcast_seg_"):]
+    if segment == "range":
+        context.user_data['awaiting_broadcast_range'] = True
+        await query.edit_message_text("Send the first and last join date as YYYY-MM-DD YYYY-MM-DD (UTC).")
+        return
+    if segment not in BROADCAST_SEGMENTS:
+        return
+    await query.edit_message_text(await choose_broadcast_segment(context, segment))
+
+@timed('handler')
+async def handle_broadcast_range(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parts = (update.message.text or "").split()
+    try:
+        first_day, last_day = (datetime.strptime(part, '%Y-%m-%d').date() for part in parts)
+    except ValueError:
+        await update.message.reply_text("Please send two dates like 2025-01-01 2025-01-31.")
+        return
+    if first_day > last_day:
+        first_day, last_day = last_day, first_day
     
-    # Send broadcast report
-    report = f"Broadcast completed!\nSuccess: {success}\nFailed: {failed}"
-    await update.message.reply_text(report)
+    context.user_data['awaiting_broadcast_range'] = False
+    await update.message.reply_text(await choose_broadcast_segment(context, f"joined:{first_day}:{last_day}"))
+
+@timed('handler')
+async def handle_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS or not context.user_data.get('awaiting_broadcast'):
+        return
     
     context.user_data['awaiting_broadcast'] = False
+    segment = context.user_data.pop('broadcast_segment', 'all')
+    
+    # The job runs in the background; progress is reported by editing this message
+    run = await broadcasts.start(
+        context.bot,
+        update.effective_user.id,
+        update.message.chat_id,
+        update.message.message_id,
+        segment
+    )
+    text, reply_markup = await broadcasts.describe(run.job_id)
+    progress = await update.message.reply_text(text, reply_markup=reply_markup)
+    run.progress_chat_id = progress.chat_id
+    run.progress_message_id = progress.message_id
+    await set_broadcast_progress_message(run.job_id, progress.chat_id, progress.message_id)
 
-async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed('handler')
+async def broadcast_job_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
     
     if query.from_user.id not in ADMIN_IDS:
+        await query.answer()
         await query.edit_message_text("You are not authorized to use this feature.")
         return
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    _, action, job_id = query.data.split("_")
+    job_id = int(job_id)
     
-    # Get user stats
-    cursor.execute("SELECT COUNT(*) FROM users")
-    total_users = cursor.fetchone()[0]
+    if action == "cancel":
+        await broadcasts.cancel(job_id)
+        await query.answer("Broadcast cancelled!")
+    else:
+        await query.answer()
+    
+    text, reply_markup = await broadcasts.describe(job_id)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if not is_not_modified(e):
+            raise
+
+async def render_payments_page(rows, has_previous):
+    pending_total, = await get_counters(['payments:pending'])
+    if not rows:
+        text = f"💳 No pending payments here ({pending_total} pending in total)."
+        keyboard = [[InlineKeyboardButton("🔄 Start over", callback_data="pay_next_0")]] if pending_total else []
+        keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="admin_back")])
+        return text, InlineKeyboardMarkup(keyboard)
+    
+    lines = [f"💳 Pending payments ({pending_total} total):", ""]
+    for payment_id, user_id, username, upi_id, amount, created_at in rows:
+        # Cut long fields so a full page stays under MESSAGE_MAX_LENGTH
+        who = f"@{shorten(username, 32)}" if username else str(user_id)
+        lines.append(f"#{payment_id} · {who} · {shorten(upi_id, UPI_ID_MAX_LENGTH)} · ₹{amount:g} · {created_at}")
+    
+    first_id, last_id = rows[0][0], rows[-1][0]
+    navigation = []
+    if has_previous:
+        navigation.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"pay_prev_{first_id}"))
+    if len(rows) == PAYMENTS_PAGE_SIZE:
+        navigation.append(InlineKeyboardButton("Next ➡️", callback_data=f"pay_next_{last_id}"))
+    
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ Approve all shown", callback_data=f"pay_approve_{first_id}_{last_id}"),
+            InlineKeyboardButton("❌ Reject all shown", callback_data=f"pay_reject_{first_id}_{last_id}")
+        ]
+    ]
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="admin_back")])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+@timed('handler')
+async def admin_payments_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer()
+        await query.edit_message_text("You are not authorized to use this feature.")
+        return
     
-    cursor.execute("SELECT COUNT(*) FROM users WHERE verified = 1")
-    verified_users = cursor.fetchone()[0]
+    parts = query.data.split("_")
+    action = parts[1]
+    
+    if action in ("approve", "reject"):
+        first_id, last_id = int(parts[2]), int(parts[3])
+        status = 'completed' if action == "approve" else 'rejected'
+        changed = await set_pending_payments_status(first_id, last_id, status)
+        await query.answer(f"{changed} payment(s) {'approved' if action == 'approve' else 'rejected'}")
+        # Show what follows the reviewed page
+        rows = await get_pending_payments_after(first_id - 1, PAYMENTS_PAGE_SIZE)
+    elif action == "prev":
+        await query.answer()
+        rows = await get_pending_payments_before(int(parts[2]), PAYMENTS_PAGE_SIZE)
+    else:
+        await query.answer()
+        after_id = int(parts[2]) if action == "next" else 0
+        rows = await get_pending_payments_after(after_id, PAYMENTS_PAGE_SIZE)
     
-    cursor.execute("SELECT COUNT(*) FROM payments WHERE status = 'completed'")
-    completed_payments = cursor.fetchone()[0]
+    has_previous = bool(rows) and await has_pending_payment_before(rows[0][0])
+    text, reply_markup = await render_payments_page(rows, has_previous)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if not is_not_modified(e):
+            raise
+
+@timed('handler')
+async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
     
-    cursor.execute("SELECT SUM(amount) FROM payments WHERE status = 'completed'")
-    total_revenue = cursor.fetchone()[0] or 0
+    if query.from_user.id not in ADMIN_IDS:
+        await query.edit_message_text("You are not authorized to use this feature.")
+        return
     
-    conn.close()
+    # Get user stats
+    total_users, verified_users, completed_payments, total_revenue = await get_stats()
+    archived_users, = await get_counters(['archived_users'])
     
     stats_text = f"""
 📊 Bot Statistics:
     
 👥 Total Users: {total_users}
+🗄 Archived Users: {archived_users}
 ✅ Verified Users: {verified_users}
 💳 Completed Payments: {completed_payments}
 💰 Total Revenue: ₹{total_revenue}
     """
     
-    await query.edit_message_text(stats_text)
+    keyboard = [
+        [InlineKeyboardButton("📈 Daily Trends", callback_data="admin_trends")],
+        [InlineKeyboardButton("⬅️ Back", callback_data="admin_back")]
+    ]
+    await query.edit_message_text(stats_text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+@timed('handler')
+async def admin_trends_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer()
+        await query.edit_message_text("You are not authorized to use this feature.")
+        return
+    
+    try:
+        await funnel_chart.send(context.bot, query.message.chat_id)
+    except RenderQueueFull:
+        await query.answer("Busy rendering images, try again in a moment.", show_alert=True)
+        return
+    await query.answer()
 
+@timed('handler')
 async def handle_admin_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -548,7 +3252,7 @@ async def handle_admin_actions(update: Update, context: ContextTypes.DEFAULT_TYP
     
     if data.startswith("delete_channel_"):
         channel_id = int(data.split("_")[2])
-        delete_channel(channel_id)
+        await delete_channel(channel_id)
         await query.edit_message_text("Channel deleted successfully!")
         await admin_channels_callback(update, context)
     
@@ -576,42 +3280,472 @@ async def handle_admin_actions(update: Update, context: ContextTypes.DEFAULT_TYP
         # Swap sequences
         for channel in channels:
             if channel[6] == new_seq:
-                update_channel_sequence(channel[0], current_seq)
+                await update_channel_sequence(channel[0], current_seq)
                 break
         
-        update_channel_sequence(channel_id, new_seq)
+        await update_channel_sequence(channel_id, new_seq)
         await query.answer("Channel order updated!")
         await admin_channels_callback(update, context)
     
     elif data == "admin_back":
-        await query.edit_message_text("Returning to main admin menu...")
         await admin(update, context)
 
-def main():
+async def post_init(application: Application):
     # Initialize database
-    init_db()
+    await init_db()
+    await metrics_server.start(port=METRICS_PORT + worker.index)
+    await channel_registry.load()
+    await image_sources.open()
+    registrations.start()
+    archiver.start()
+    warm_snapshot.start()
+    admin_notifier.start(application.bot)
+    
+    # Pick up broadcasts interrupted by a restart; with several workers only the leader sends
+    if worker.leader:
+        await broadcasts.resume(application.bot)
+    if worker.sharded:
+        shared_state.start(application.bot)
+
+async def post_stop(application: Application):
+    await profiler.stop()
+    await shared_state.stop()
+    await broadcasts.stop()
+    await registrations.stop()
+    await archiver.stop()
+    await warm_snapshot.stop()
+    await admin_notifier.stop()
+
+async def post_shutdown(application: Application):
+    await metrics_server.stop()
+    await image_sources.close()
+    renderer.close()
+    db.close()
+
+# Shared state across workers
+class SharedStateWatcher:
+    # In supervisor mode each worker keeps its own channel registry and image
+    # cache. Writes to either bump a version counter in the same transaction;
+    # workers poll the counters and reload what another worker changed.
+    # /profile requests for another worker travel the same way.
+    WATCHED = ('channels_version', 'image_cache_version', 'archive_version', 'profile_version')
+
+    def __init__(self):
+        self.versions = None
+        self.archived_since = ''  # archived_at of the newest archived user already forgotten here
+        self._bot = None
+        self._tasks = []
+
+    def start(self, bot):
+        self._bot = bot
+        self._tasks = [asyncio.create_task(self._run())]
+        if worker.leader:
+            self._tasks.append(asyncio.create_task(broadcasts.watch(bot)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _run(self):
+        self.versions = await get_counters(self.WATCHED)
+        self.archived_since = await get_latest_archive_time()
+        while True:
+            await asyncio.sleep(SHARED_STATE_INTERVAL)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Error checking shared state: {e}")
+
+    async def check(self):
+        channels_version, image_cache_version, archive_version, profile_version = versions = await get_counters(self.WATCHED)
+        if channels_version != self.versions[0]:
+            await channel_registry.load()
+        if image_cache_version != self.versions[1]:
+            image_cache.entries.clear()
+        if archive_version != self.versions[2]:
+            # Forget just the users the leader archived since the last check
+            user_ids, self.archived_since = await get_archived_since(self.archived_since)
+            archiver.forget(user_ids)
+        if profile_version != self.versions[3]:
+            request = await claim_profile_request(worker.index)
+            if request and profiler.running:
+                await self._bot.send_message(request[0], f"Worker {worker.index} is already being profiled.")
+            elif request:
+                profiler.start(self._bot, *request)
+        self.versions = versions
+
+shared_state = SharedStateWatcher()
+
+# Update processing
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Runs up to max_concurrent_updates handlers at once while updates from
+    # the same user (or chat, for updates without a user) keep their order
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}
+        self.pending = 0  # Accepted but unfinished, including updates waiting for a worker
+
+    @staticmethod
+    def ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def process_update(self, update, coroutine):
+        # The per-user lock is taken before the base class takes a worker
+        # slot, so a burst from one user queues behind its own lock instead
+        # of filling every slot while everyone else waits
+        self.pending += 1
+        key = self.ordering_key(update)
+        try:
+            if key is None:
+                await super().process_update(update, coroutine)
+                return
+            
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await super().process_update(update, coroutine)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+        finally:
+            self.pending -= 1
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def build_application(base_url=None):
+    # base_url points the bot at another Bot API server (e.g. the load-test stand-in)
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_WORKERS))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .rate_limiter(outbound)
+        .persistence(SqlitePersistence())
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if METRICS_ENABLED:
+        builder = builder.request(InstrumentedRequest(connection_pool_size=BOT_API_POOL_SIZE))
     
     # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = builder.build()
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("admin", admin))
+    application.add_handler(CommandHandler("imagecache", image_cache_command))
+    application.add_handler(CommandHandler("metrics", metrics_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("archive", archive_command))
     
     application.add_handler(CallbackQueryHandler(verify_join_callback, pattern="^verify_join$"))
     application.add_handler(CallbackQueryHandler(admin_channels_callback, pattern="^admin_channels$"))
     application.add_handler(CallbackQueryHandler(add_channel_callback, pattern="^add_channel$"))
     application.add_handler(CallbackQueryHandler(admin_broadcast_callback, pattern="^admin_broadcast$"))
     application.add_handler(CallbackQueryHandler(admin_stats_callback, pattern="^admin_stats$"))
+    application.add_handler(CallbackQueryHandler(admin_trends_callback, pattern="^admin_trends$"))
+    application.add_handler(CallbackQueryHandler(admin_payments_callback, pattern=r"^(admin_payments|pay_(next|prev)_\d+|pay_(approve|reject)_\d+_\d+)$"))
+    application.add_handler(CallbackQueryHandler(broadcast_segment_callback, pattern=r"^bcast_seg_\w+$"))
+    application.add_handler(CallbackQueryHandler(broadcast_job_callback, pattern=r"^bcast_(status|cancel)_\d+$"))
     application.add_handler(CallbackQueryHandler(handle_admin_actions))
     
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_code))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_upi))
-    application.add_handler(MessageHandler(filters.FORWARDED, handle_channel_forward))
-    application.add_handler(MessageHandler(filters.ALL, handle_broadcast_message))
+    application.add_handler(ChatMemberHandler(track_channel_member, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(ChatMemberHandler(track_bot_blocked, ChatMemberHandler.MY_CHAT_MEMBER))
+    
+    # Activity is noted ahead of (and independently from) the handlers above
+    application.add_handler(TypeHandler(Update, track_activity), group=-1)
+    
+    # One router for every plain message; it dispatches on admin input flags and funnel state
+    application.add_handler(MessageHandler(filters.UpdateType.MESSAGE & ~filters.COMMAND, route_message))
+    
+    return application
+
+# Webhook mode
+def webhook_secret():
+    # Admin checks trust update.effective_user, so the webhook must never be
+    # open: without a configured secret a random one is registered with
+    # setWebhook (replay mode then needs WEBHOOK_SECRET set)
+    return WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+def make_webhook_app(application, secret_token, path=WEBHOOK_PATH):
+    # Updates are only queued here; PerUserUpdateProcessor runs them concurrently
+    async def receive_update(request):
+        if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret_token:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+    
+    async def health(request):
+        return web.Response(text="ok")
+    
+    web_app = web.Application()
+    web_app.router.add_post(path, receive_update)
+    web_app.router.add_get('/healthz', health)
+    return web_app
+
+async def serve_webhook(application, host=WEBHOOK_HOST, port=WEBHOOK_PORT, public_url=WEBHOOK_URL, secret_token=None):
+    # Application.run_webhook would also work, but this server lets recorded
+    # updates be posted locally and shares the process with other endpoints
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    
+    secret_token = secret_token or webhook_secret()
+    runner = web.AppRunner(make_webhook_app(application, secret_token))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Webhook server listening on {host}:{port}{WEBHOOK_PATH}")
+    
+    if public_url:
+        await application.bot.set_webhook(
+            url=f"{public_url}{WEBHOOK_PATH}",
+            secret_token=secret_token,
+            max_connections=UPDATE_WORKERS,
+            allowed_updates=Update.ALL_TYPES
+        )
+    
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+async def replay_updates(path, url, secret_token=WEBHOOK_SECRET):
+    # Posts recorded updates (one JSON object per line) to a running webhook server
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token} if secret_token else {}
+    statuses = {}
+    started = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                async with session.post(url, data=line, headers={**headers, 'Content-Type': 'application/json'}) as response:
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+    elapsed = time.monotonic() - started
+    logger.info(f"Replayed {sum(statuses.values())} updates in {elapsed:.2f}s, responses: {statuses}")
+    return statuses
+
+# Supervisor mode
+# The supervisor takes Telegram's webhook, hashes each update's user id to
+# one of N worker processes and forwards it, in arrival order, to that
+# worker's local webhook server. A user's updates therefore always land on
+# the same worker, in order. Workers share bot.db (WAL with busy_timeout;
+# each worker still has its single writer thread) and split the outbound
+# message rate between them.
+def update_shard_key(data):
+    # The user an update comes from, else its chat, read straight from the JSON
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get('from') or value.get('user')
+        if isinstance(sender, dict) and 'id' in sender:
+            return sender['id']
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    return None
+
+def run_worker(index, count, port, outbound_values, secret_token):
+    # Entry point of a worker process; outbound_values is the shared OutboundBudget state
+    worker.index, worker.count = index, count
+    outbound.budget = OutboundBudget(OUTBOUND_RATE, outbound_values)
+    db.ready = True  # The supervisor ran init_db before spawning workers
+    application = build_application()
+    asyncio.run(serve_webhook(application, '127.0.0.1', port, public_url='', secret_token=secret_token))
+
+class Supervisor:
+    def __init__(self, count=SUPERVISOR_WORKERS, base_port=WORKER_BASE_PORT):
+        self.count = count
+        self.ports = [base_port + index for index in range(count)]
+        self.processes = [None] * count
+        self.queues = []
+        self.stopping = False
+        self._context = multiprocessing.get_context('spawn')
+        self.outbound_values = OutboundBudget.shared_values(self._context)
+        self.secret_token = webhook_secret()  # Used by Telegram and for forwarding to workers
+
+    def spawn(self, index):
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self.count, self.ports[index], self.outbound_values, self.secret_token),
+            name=f"bot-worker-{index}"
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Started worker {index} (pid {process.pid}) on port {self.ports[index]}")
+
+    async def _monitor(self):
+        while not self.stopping:
+            await asyncio.sleep(1)
+            for index, process in enumerate(self.processes):
+                if not self.stopping and not process.is_alive():
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    self.spawn(index)
+
+    async def _forward(self, session, index):
+        # One update at a time per worker keeps each user's updates in order;
+        # while a worker is (re)starting its updates wait here
+        url = f"http://127.0.0.1:{self.ports[index]}{WEBHOOK_PATH}"
+        headers = {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': self.secret_token}
+        queue = self.queues[index]
+        while True:
+            body = await queue.get()
+            delay = 0.2
+            while True:
+                try:
+                    async with session.post(url, data=body, headers=headers) as response:
+                        if response.status < 500:
+                            break
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    def make_app(self):
+        async def receive_update(request):
+            if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+                return web.Response(status=403)
+            body = await request.read()
+            try:
+                key = update_shard_key(json.loads(body))
+            except (ValueError, AttributeError):
+                return web.Response(status=400)
+            try:
+                self.queues[(key or 0) % self.count].put_nowait(body)
+            except asyncio.QueueFull:
+                return web.Response(status=503)  # Telegram redelivers later
+            return web.Response()
+        
+        async def health(request):
+            alive = sum(1 for process in self.processes if process and process.is_alive())
+            return web.Response(text=f"{alive}/{self.count} workers alive")
+        
+        web_app = web.Application()
+        web_app.router.add_post(WEBHOOK_PATH, receive_update)
+        web_app.router.add_get('/healthz', health)
+        return web_app
+
+    async def run(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT, public_url=WEBHOOK_URL):
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        
+        def request_stop():
+            # Set before workers start exiting on the same Ctrl+C, so none is restarted
+            self.stopping = True
+            stop_event.set()
+        
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, request_stop)
+        
+        # Schema and migrations run once here, not concurrently in every worker
+        await init_db()
+        db.close()
+        
+        self.queues = [asyncio.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(self.count)]
+        for index in range(self.count):
+            self.spawn(index)
+        
+        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+        tasks = [asyncio.create_task(self._forward(session, index)) for index in range(self.count)]
+        tasks.append(asyncio.create_task(self._monitor()))
+        
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logger.info(f"Supervisor listening on {host}:{port}{WEBHOOK_PATH} with {self.count} workers")
+        
+        if public_url:
+            async with Bot(BOT_TOKEN) as telegram_bot:
+                await telegram_bot.set_webhook(
+                    url=f"{public_url}{WEBHOOK_PATH}",
+                    secret_token=self.secret_token,
+                    max_connections=UPDATE_WORKERS,
+                    allowed_updates=Update.ALL_TYPES
+                )
+        
+        try:
+            await stop_event.wait()
+        finally:
+            await runner.cleanup()
+            # Give queued updates a moment to reach their workers
+            deadline = time.monotonic() + 5
+            while any(queue.qsize() for queue in self.queues) and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await session.close()
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in self.processes:
+                await loop.run_in_executor(None, process.join)
+
+def main():
+    parser = argparse.ArgumentParser(description="Channel verification bot")
+    parser.add_argument('mode', nargs='?', choices=['polling', 'webhook', 'replay', 'supervisor'], default='polling')
+    parser.add_argument('--host', default=WEBHOOK_HOST)
+    parser.add_argument('--port', type=int, default=WEBHOOK_PORT)
+    parser.add_argument('--url', default=WEBHOOK_URL, help="Public base URL registered with setWebhook")
+    parser.add_argument('--updates', help="JSON-lines file of recorded updates (replay mode)")
+    parser.add_argument('--secret', default=WEBHOOK_SECRET, help="Webhook secret of the server to replay to")
+    parser.add_argument('--workers', type=int, default=SUPERVISOR_WORKERS, help="Worker processes (supervisor mode)")
+    args = parser.parse_args()
+    
+    if args.mode == 'replay':
+        # e.g. python bot.py replay --updates updates.jsonl --port 8443
+        asyncio.run(replay_updates(args.updates, f"http://127.0.0.1:{args.port}{WEBHOOK_PATH}", args.secret))
+        return
+    
+    if args.mode == 'supervisor':
+        # e.g. python bot.py supervisor --workers 4 --url https://yourdomain.com
+        asyncio.run(Supervisor(args.workers).run(args.host, args.port, args.url))
+        return
+    
+    application = build_application()
     
     # Start the bot
-    application.run_polling()
+    if args.mode == 'webhook':
+        asyncio.run(serve_webhook(application, args.host, args.port, args.url))
+    else:
+        # chat_member updates are only delivered when asked for explicitly
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
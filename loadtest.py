@@ -0,0 +1,405 @@
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import tempfile
+import time
+
+from aiohttp import web
+from PIL import Image
+from telegram import Update
+
+import deepseek_python_20250820_f8d89e as bot
+
+# Load-test harness
+# Runs the real handlers against a local stand-in for the Bot API and replays
+# synthetic /start, verify_join, code, UPI and broadcast traffic, then reports
+# throughput and per-handler latency percentiles.
+#
+#   python loadtest.py --users 2000 --concurrency 200 --latency-ms 40 --rate-429 0.01
+#   python loadtest.py --encode-benchmark
+
+logger = logging.getLogger("loadtest")
+
+FAKE_BOT_ID = 1000000001
+FAKE_BOT_TOKEN_ROUTE = "/bot{token}/{method}"
+
+# Fake Telegram Bot API
+class FakeBotApi:
+    # Answers Bot API calls with minimal valid payloads after a configurable
+    # latency; a fraction of calls can be answered with 429 RetryAfter
+    def __init__(self, latency_ms=30, jitter_ms=10, rate_429=0.0, retry_after=1, member_status="member"):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.member_status = member_status
+        self.calls = {}
+        self.throttled = {}
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._image = self._make_image()
+        self.runner = None
+        self.url = None
+
+    @staticmethod
+    def _make_image():
+        image = Image.new("RGB", (1280, 720), (40, 90, 160))
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=85)
+        return output.getvalue()
+
+    async def start(self, host="127.0.0.1", port=8081):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post(FAKE_BOT_TOKEN_ROUTE, self.handle_call)
+        app.router.add_get("/images/{name}", self.handle_image)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def handle_image(self, request):
+        return web.Response(body=self._image, content_type="image/jpeg", headers={"ETag": '"loadtest-v1"'})
+
+    async def handle_call(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        delay = max(0.0, random.gauss(self.latency_ms, self.jitter_ms)) / 1000
+        await asyncio.sleep(delay)
+
+        if method != "getMe" and random.random() < self.rate_429:
+            self.throttled[method] = self.throttled.get(method, 0) + 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+
+        return web.json_response({"ok": True, "result": self.result_for(method, params)})
+
+    def _message(self, chat_id, **fields):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": self.bot_user(),
+            **fields
+        }
+
+    @staticmethod
+    def bot_user():
+        return {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+
+    def result_for(self, method, params):
+        chat_id = params.get("chat_id", 0)
+        if method == "getMe":
+            return {**self.bot_user(), "can_join_groups": True, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        if method == "getChatMember":
+            user_id = int(params.get("user_id", 0))
+            status = "administrator" if user_id == FAKE_BOT_ID else self.member_status
+            member = {"status": status, "user": {"id": user_id, "is_bot": False, "first_name": "User"}}
+            if status == "administrator":
+                member.update({
+                    "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True,
+                    "can_delete_messages": True, "can_manage_video_chats": True, "can_restrict_members": True,
+                    "can_promote_members": False, "can_change_info": True, "can_invite_users": True
+                })
+            return member
+        if method == "sendPhoto":
+            file_number = next(self._file_ids)
+            return self._message(chat_id, photo=[{
+                "file_id": f"photo-{file_number}",
+                "file_unique_id": f"unique-{file_number}",
+                "width": 1280,
+                "height": 720
+            }], caption=params.get("caption"))
+        if method in ("sendMessage", "editMessageText", "editMessageCaption"):
+            return self._message(chat_id, text=params.get("text") or params.get("caption") or "")
+        if method in ("forwardMessage", "copyMessage"):
+            return self._message(chat_id, text="forwarded")
+        if method == "createChatInviteLink":
+            return {"invite_link": "https://t.me/+loadtest", "creator": self.bot_user(),
+                    "creates_join_request": False, "is_primary": False, "is_revoked": False}
+        return True
+
+# Synthetic traffic
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def message(self, user_id, text, entities=None):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self.user(user_id),
+            "text": text
+        }
+        if entities:
+            message["entities"] = entities
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def command(self, user_id, command):
+        return self.message(user_id, f"/{command}", [{"type": "bot_command", "offset": 0, "length": len(command) + 1}])
+
+    def callback(self, user_id, data):
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self.user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": next(self._message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": FakeBotApi.bot_user(),
+                    "caption": "Welcome!",
+                    "photo": [{"file_id": "photo-0", "file_unique_id": "unique-0", "width": 1280, "height": 720}]
+                }
+            }
+        }
+
+class LatencyStats:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.names = {}  # update_id -> handler name while the update is in flight
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def error(self, name):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def on_error(self, update, context):
+        # Application error handler: handlers never raise into process_update
+        name = self.names.get(getattr(update, "update_id", None), "unknown")
+        logger.error(f"{name} failed: {context.error!r}")
+        self.error(name)
+
+    @staticmethod
+    def percentile(sorted_samples, fraction):
+        if not sorted_samples:
+            return 0.0
+        # Nearest-rank percentile
+        rank = math.ceil(fraction * len(sorted_samples))
+        return sorted_samples[min(len(sorted_samples), max(rank, 1)) - 1]
+
+    def summary(self):
+        rows = {}
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            rows[name] = {
+                "count": len(ordered),
+                "errors": self.errors.get(name, 0),
+                "p50_ms": self.percentile(ordered, 0.50) * 1000,
+                "p95_ms": self.percentile(ordered, 0.95) * 1000,
+                "p99_ms": self.percentile(ordered, 0.99) * 1000,
+                "max_ms": ordered[-1] * 1000
+            }
+        return rows
+
+async def timed(application, stats, name, data):
+    # Handed to the update processor the way fetched updates are, so per-user
+    # ordering, the worker slots and the flood limiter's load signal all apply
+    update = Update.de_json(data, application.bot)
+    stats.names[update.update_id] = name
+    started = time.perf_counter()
+    try:
+        await application.update_processor.process_update(update, application.process_update(update))
+    finally:
+        stats.names.pop(update.update_id, None)
+    stats.add(name, time.perf_counter() - started)
+
+async def user_funnel(application, stats, factory, user_id):
+    # One user walking the whole funnel, one step after the other
+    await timed(application, stats, "start", factory.command(user_id, "start"))
+    await timed(application, stats, "verify_join_callback", factory.callback(user_id, "verify_join"))
+    await timed(application, stats, "handle_code", factory.message(user_id, bot.VERIFICATION_CODE))
+    await timed(application, stats, "handle_upi", factory.message(user_id, f"user{user_id}@upi"))
+
+async def run_funnels(application, stats, factory, users, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(user_id):
+        async with semaphore:
+            await user_funnel(application, stats, factory, user_id)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(100000 + i) for i in range(users)))
+    return time.perf_counter() - started
+
+async def run_broadcast(application, stats, factory, fake):
+    admin_id = bot.ADMIN_IDS[0]
+    await bot.registrations.flush()
+    await timed(application, stats, "admin_broadcast_callback", factory.callback(admin_id, "admin_broadcast"))
+    await timed(application, stats, "broadcast_segment_callback", factory.callback(admin_id, "bcast_seg_all"))
+    forwarded_before = fake.calls.get("forwardMessage", 0)
+
+    started = time.perf_counter()
+    await timed(application, stats, "handle_broadcast_message", factory.message(admin_id, "Load test broadcast"))
+    while bot.broadcasts.runs:
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - started
+    return fake.calls.get("forwardMessage", 0) - forwarded_before, elapsed
+
+# Encoding benchmark
+# Compares the photo encoding stage with the full-resolution PNG renders the
+# bot used to upload, on synthetic photo-like sources of common sizes.
+BENCHMARK_SIZES = ((1280, 720), (1920, 1080), (4000, 3000))
+
+def make_source_image(width, height):
+    # Gradient plus noise, which compresses about as badly as a real photo
+    noise = Image.effect_noise((width, height), 40)
+    gradient = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+def render_png(data, text):
+    # The previous pipeline: full-size decode, draw, lossless PNG
+    image = Image.open(io.BytesIO(data))
+    draw = bot.ImageDraw.Draw(image)
+    draw.text((50, image.height - 100), text, fill=(255, 255, 255), font=bot.load_font(bot.IMAGE_FONT_PATH, bot.IMAGE_FONT_SIZE))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+def render_encoded(data, text):
+    source = bot.SourceImage(data, None, None, None)
+    return bot.render_text_on_image(source, text)
+
+def measure(fn, data, text, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        rendered = fn(data, text)
+        timings.append(time.perf_counter() - started)
+    return len(rendered), LatencyStats.percentile(sorted(timings), 0.50) * 1000
+
+def run_encode_benchmark(iterations):
+    text = bot.WELCOME_IMAGE[1]
+    print(f"\n{'source':<12}{'PNG bytes':>12}{'PNG ms':>9}"
+          f"{bot.PHOTO_FORMAT + ' bytes':>13}{bot.PHOTO_FORMAT + ' ms':>10}{'saved':>8}")
+    rows = []
+    for width, height in BENCHMARK_SIZES:
+        data = make_source_image(width, height)
+        png_bytes, png_ms = measure(render_png, data, text, iterations)
+        new_bytes, new_ms = measure(render_encoded, data, text, iterations)
+        rows.append({"source": f"{width}x{height}", "png_bytes": png_bytes, "png_ms": png_ms,
+                     "encoded_bytes": new_bytes, "encoded_ms": new_ms, "format": bot.PHOTO_FORMAT})
+        print(f"{width}x{height:<7}{png_bytes:>12}{png_ms:>9.1f}{new_bytes:>13}{new_ms:>10.1f}"
+              f"{1 - new_bytes / png_bytes:>8.0%}")
+    return {"encode_benchmark": rows}
+
+# Reporting
+def print_report(results):
+    print(f"\nFunnel: {results['users']} users in {results['funnel_seconds']:.2f}s "
+          f"({results['updates_per_second']:.1f} updates/s)")
+    if "broadcast_sent" in results:
+        print(f"Broadcast: {results['broadcast_sent']} sends in {results['broadcast_seconds']:.2f}s "
+              f"({results['broadcast_per_second']:.1f} msg/s)")
+    print(f"\n{'handler':<28}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, row in results["handlers"].items():
+        print(f"{name:<28}{row['count']:>8}{row['errors']:>8}{row['p50_ms']:>10.1f}"
+              f"{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}")
+    print(f"\nBot API calls: {json.dumps(results['api_calls'], sort_keys=True)}")
+    print(f"429 injected: {json.dumps(results['api_throttled'], sort_keys=True)}")
+
+async def run(args):
+    fake = FakeBotApi(args.latency_ms, args.jitter_ms, args.rate_429)
+    await fake.start(args.host, args.port)
+
+    # Fresh database and local images so runs are independent of production data
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    bot.db = bot.Storage(os.path.join(workdir, "bot.db"))
+    bot.WELCOME_IMAGE = (f"{fake.url}/images/welcome.jpg", bot.WELCOME_IMAGE[1])
+    bot.VERIFICATION_IMAGE = (f"{fake.url}/images/verification.jpg", bot.VERIFICATION_IMAGE[1])
+    bot.outbound.budget = bot.OutboundBudget(args.outbound_rate)
+
+    stats = LatencyStats()
+    application = bot.build_application(base_url=f"{fake.url}/bot")
+    application.add_error_handler(stats.on_error)
+    await application.initialize()
+    await application.post_init(application)
+
+    for i in range(args.channels):
+        await bot.add_channel(-1000000000 - i, f"loadtest{i}", f"Channel {i}", f"https://t.me/loadtest{i}", 0)
+
+    factory = UpdateFactory()
+    results = {"users": args.users}
+    try:
+        funnel_seconds = await run_funnels(application, stats, factory, args.users, args.concurrency)
+        results["funnel_seconds"] = funnel_seconds
+        results["updates_per_second"] = args.users * 4 / funnel_seconds if funnel_seconds else 0.0
+
+        if not args.skip_broadcast:
+            sent, broadcast_seconds = await run_broadcast(application, stats, factory, fake)
+            results["broadcast_sent"] = sent
+            results["broadcast_seconds"] = broadcast_seconds
+            results["broadcast_per_second"] = sent / broadcast_seconds if broadcast_seconds else 0.0
+    finally:
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
+        await fake.stop()
+
+    results["handlers"] = stats.summary()
+    results["api_calls"] = fake.calls
+    results["api_throttled"] = fake.throttled
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot against a local fake Bot API")
+    parser.add_argument("--users", type=int, default=500, help="Synthetic users walking the funnel")
+    parser.add_argument("--concurrency", type=int, default=100, help="Users active at the same time")
+    parser.add_argument("--channels", type=int, default=10, help="Required channels to verify")
+    parser.add_argument("--latency-ms", type=float, default=30, help="Mean Bot API latency")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="Bot API latency standard deviation")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of calls answered with 429")
+    parser.add_argument("--outbound-rate", type=float, default=1000,
+                        help=f"Global messages/s allowed by the outbound scheduler (Telegram's is {bot.OUTBOUND_RATE})")
+    parser.add_argument("--skip-broadcast", action="store_true")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--encode-benchmark", action="store_true",
+                        help="Only benchmark photo encoding against the old PNG renders")
+    parser.add_argument("--iterations", type=int, default=5, help="Renders timed per source in the encoding benchmark")
+    args = parser.parse_args()
+
+    logging.getLogger("deepseek_python_20250820_f8d89e").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if args.encode_benchmark:
+        results = run_encode_benchmark(args.iterations)
+    else:
+        results = asyncio.run(run(args))
+        print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()